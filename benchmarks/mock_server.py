@@ -0,0 +1,179 @@
+# A local stand-in for the OpenAI and Azure OpenAI chat completions endpoints, so lloom can be benchmarked without network or quota
+# Run it on its own with `python benchmarks/mock_server.py --port 8000 --latency 0.2` and point api_base to http://127.0.0.1:8000/
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = "the quick brown fox jumps over the lazy dog while the model keeps on writing".split()
+
+class MockSettings:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, tokens_per_second: float = 500, response_words: int = 50, error_429_rate: float = 0.0, error_500_rate: float = 0.0, retry_after: float = 0.05):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.response_words = response_words
+        self.error_429_rate = error_429_rate
+        self.error_500_rate = error_500_rate
+        self.retry_after = retry_after
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, with Nagle on every keep-alive request would wait for a delayed ACK
+    disable_nagle_algorithm = True
+    settings = MockSettings()
+    stats = {"requests": 0, "errors": 0}
+    stats_lock = threading.Lock()
+    azure_route = re.compile(r"^/openai/deployments/[^/]+/chat/completions")
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.stats_lock:
+                self._send_json(200, dict(self.stats))
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown route {self.path}"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/v1/chat/completions" and not self.azure_route.match(self.path):
+            self._send_json(404, {"error": {"message": f"Unknown route {self.path}"}})
+            return
+        with self.stats_lock:
+            self.stats["requests"] += 1
+        settings = self.settings
+        roll = random.random()
+        if roll < settings.error_429_rate:
+            self._send_error(429, "Rate limit reached", {"Retry-After": str(settings.retry_after)})
+            return
+        if roll < settings.error_429_rate + settings.error_500_rate:
+            self._send_error(500, "The server had an error while processing your request")
+            return
+        data = json.loads(body)
+        time.sleep(max(0.0, settings.latency + random.uniform(-settings.jitter, settings.jitter)))
+        words = min(settings.response_words, data.get("max_tokens") or settings.response_words)
+        content = [WORDS[i % len(WORDS)] for i in range(words)]
+        prompt_tokens = sum(len(message["content"]) for message in data["messages"]) // 4
+        if data.get("stream"):
+            self._send_stream(content)
+        else:
+            time.sleep(words / settings.tokens_per_second)
+            self._send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "model": data.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(content)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": words, "total_tokens": prompt_tokens + words},
+            })
+
+    def _rate_limit_headers(self):
+        self.send_header("x-ratelimit-remaining-requests", "10000")
+        self.send_header("x-ratelimit-reset-requests", "1s")
+        self.send_header("x-ratelimit-remaining-tokens", "10000000")
+        self.send_header("x-ratelimit-reset-tokens", "1s")
+
+    def _send_error(self, status, message, headers=None):
+        with self.stats_lock:
+            self.stats["errors"] += 1
+        self._send_json(status, {"error": {"message": message}}, headers)
+
+    def _send_json(self, status, payload, headers=None):
+        out = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self._rate_limit_headers()
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _send_stream(self, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self._rate_limit_headers()
+        self.end_headers()
+        try:
+            for i, word in enumerate(content):
+                delta = {"content": word if i == 0 else " " + word}
+                self._write_chunk("data: " + json.dumps({"choices": [{"index": 0, "delta": delta}]}) + "\n\n")
+                time.sleep(1 / self.settings.tokens_per_second)
+            self._write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client closed the stream early, which is exactly what a stop sequence is supposed to do
+            self.close_connection = True
+
+    def _write_chunk(self, text):
+        chunk = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.flush()
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # streaming clients drop keep-alive connections as soon as they see [DONE], that's not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class MockServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, settings: MockSettings = None):
+        handler = type("Handler", (MockHandler,), {"settings": settings or MockSettings(), "stats": {"requests": 0, "errors": 0}})
+        self.server = QuietHTTPServer((host, port), handler)
+        self.handler = handler
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @property
+    def stats(self):
+        return self.handler.stats
+
+    def start(self) -> "MockServer":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI/Azure OpenAI chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds added to the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=500)
+    parser.add_argument("--response-words", type=int, default=50)
+    parser.add_argument("--error-429-rate", type=float, default=0.0)
+    parser.add_argument("--error-500-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    settings = MockSettings(args.latency, args.jitter, args.tokens_per_second, args.response_words, args.error_429_rate, args.error_500_rate)
+    server = MockServer(args.host, args.port, settings)
+    print(f"listening on {server.url}", flush=True)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# Offline benchmarks for lloom. Every scenario talks to benchmarks/mock_server.py running in a separate process,
+# so the CPU time reported here is the client's own overhead: tokenization, context fitting, serialization, logging and the HTTP client
+# Usage: python benchmarks/run.py [--scenarios overhead summarization camel dnd memory sessions] [--latency 0.05] [--error-429-rate 0.05] [--json results.json]
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# benchmark the working tree rather than whatever version of lloom is installed
+sys.path.insert(0, ROOT)
+
+from lloom import LloomConfig, Lloom, HTTPTransport, SessionManager, _encode_request
+
+MODEL = "gpt-3.5-turbo-0613"
+PAGE = " ".join(f"Sentence {i} explains how virtual prompt injection steers an instruction-tuned model." for i in range(40))
+SYSTEM_MESSAGE = " ".join(f"Rule {i}: never forget your role and never flip roles with the user." for i in range(40))
+
+class TimedTransport(HTTPTransport):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def post(self, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().post(*args, **kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        return response
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def latency_stats(prefix, values):
+    return {f"{prefix} p50 ms": percentile(values, 50) * 1000, f"{prefix} p99 ms": percentile(values, 99) * 1000}
+
+class Timer:
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+
+def start_server(args):
+    command = [
+        sys.executable, os.path.join(ROOT, "benchmarks", "mock_server.py"), "--port", "0",
+        "--latency", str(args.latency), "--tokens-per-second", str(args.tokens_per_second), "--response-words", str(args.response_words),
+        "--error-429-rate", str(args.error_429_rate), "--error-500-rate", str(args.error_500_rate),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().split()[-1]
+    return process, url
+
+def server_stats(url):
+    with urllib.request.urlopen(f"{url}stats") as response:
+        return json.loads(response.read())
+
+def make_loom(url, transport=None, **config):
+    return Lloom(LloomConfig(api_key="benchmark", api_base=url, model=MODEL, logging=False, **config), transport=transport)
+
+def bench_overhead(url, args):
+    loom = make_loom(url, system_message=SYSTEM_MESSAGE)
+    for i in range(args.history // 2):
+        loom.add_user_message(f"Instruction {i}: {PAGE[:400]}")
+        loom.add_assistant_message(f"Solution {i}: {PAGE[:400]}")
+    messages = loom.history.to_list()
+    tokens = loom.history.token_list()
+    runs = args.repeat
+
+    def per_call(fn, number=runs):
+        return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+    return {
+        "history messages": len(messages),
+        "get_token_count (full) us": per_call(lambda: loom.get_token_count(messages, loom.model), max(1, runs // 20)),
+        "get_history_token_count us": per_call(loom.get_history_token_count),
+        "context fitting us": per_call(lambda: loom._fit_context(messages, tokens)),
+        "request serialization us": per_call(lambda: _encode_request(loom._build_request(messages)[2])),
+        "add_user_message us": per_call(lambda: loom.add_user_message(PAGE[:400])),
+    }
+
+def bench_summarization(url, args):
+    transport = TimedTransport(pool_size=args.pages)
+    loom = make_loom(url, transport=transport)
+    pages = [f"Page {i}. {PAGE}" for i in range(args.pages)]
+    results = {}
+    with Timer() as timer:
+        answers = loom.generate_many([f"Write a concise summary of the following: {page}" for page in pages])
+        loom.generate(f"Write a short and concise summary for these pieces of text: {', '.join(a for a in answers if isinstance(a, str))}")
+        loom.clear_history()
+    results.update({"map-reduce wall s": timer.wall, "map-reduce cpu s": timer.cpu})
+    with Timer() as timer:
+        answer = ""
+        for page in pages:
+            answer = loom.generate(f"We have provided an existing summary up to a certain point: {answer}\nRefine it with this context: {page}")
+            loom.clear_history()
+    results.update({"refine wall s": timer.wall, "refine cpu s": timer.cpu})
+    with Timer() as timer:
+        for page in pages:
+            loom.generate(f"Use the following pieces of context to answer the question at the end.\nContext: {page}\nQuestion: What is poisoning rate?\nHelpful Answer:")
+            loom.clear_history()
+    results.update({"rerank wall s": timer.wall, "rerank cpu s": timer.cpu})
+    results["requests"] = len(transport.latencies)
+    results.update(latency_stats("request", transport.latencies))
+    return results
+
+def bench_camel(url, args):
+    transport = TimedTransport(pool_size=2)
+    user_agent = make_loom(url, transport=transport, temperature=0.2, system_message=SYSTEM_MESSAGE)
+    assistant_agent = make_loom(url, transport=transport, temperature=0.2, system_message=SYSTEM_MESSAGE)
+    turn_latencies = []
+    assistant_msg = "Now start to give me instructions one by one. Only reply with Instruction and Input."
+    with Timer() as timer:
+        for _ in range(args.turns):
+            start = time.perf_counter()
+            user_msg = user_agent.generate(assistant_msg)
+            assistant_msg = assistant_agent.generate(user_msg)
+            turn_latencies.append(time.perf_counter() - start)
+    results = {
+        "turns": args.turns,
+        "wall s": timer.wall,
+        "cpu s": timer.cpu,
+        "cpu per turn ms": timer.cpu / args.turns * 1000,
+        "turns per s": args.turns / timer.wall,
+    }
+    results.update(latency_stats("turn", turn_latencies))
+    results.update(latency_stats("request", transport.latencies))
+    return results
+
+def bench_dnd(url, args):
+    master = make_loom(url, temperature=1.0, system_message=SYSTEM_MESSAGE)
+    first_token, total = [], []
+    with Timer() as timer:
+        for turn in range(args.turns):
+            start = time.perf_counter()
+            deltas = master.generate_stream(f"I open the chest number {turn}, roll a dice for me")
+            next(deltas)
+            first_token.append(time.perf_counter() - start)
+            for _ in deltas:
+                pass
+            total.append(time.perf_counter() - start)
+    results = {"turns": args.turns, "wall s": timer.wall, "cpu s": timer.cpu}
+    results.update(latency_stats("first token", first_token))
+    results.update(latency_stats("full response", total))
+    return results
+
+def bench_memory(url, args):
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    conversations = []
+    for _ in range(args.conversations):
+        loom = make_loom(url, system_message=SYSTEM_MESSAGE)
+        for i in range(args.turns):
+            loom.add_user_message(f"Instruction {i}")
+            loom.add_assistant_message(f"Solution {i}: {PAGE[:200]}")
+        conversations.append(loom)
+    built = tracemalloc.get_traced_memory()[0]
+    forks = [loom.fork() for loom in conversations for _ in range(10)]
+    forked = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        "conversations": len(conversations),
+        "turns per conversation": args.turns,
+        "bytes per conversation": (built - baseline) / len(conversations),
+        "bytes per fork": (forked - built) / len(forks),
+    }
+
+def bench_sessions(url, args):
+    manager = SessionManager(make_loom(url, system_message=SYSTEM_MESSAGE), max_in_flight=args.max_in_flight)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for i in range(args.sessions):
+        manager.get(f"user {i}")
+    opened = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    turn_latencies = []
+
+    async def chat(session_id):
+        for turn in range(args.session_turns):
+            start = time.perf_counter()
+            await manager.agenerate(session_id, f"Message {turn}: {PAGE[:200]}")
+            turn_latencies.append(time.perf_counter() - start)
+
+    async def run():
+        await asyncio.gather(*[chat(f"user {i}") for i in range(args.sessions)])
+        await manager.client.async_transport.close()
+
+    with Timer() as timer:
+        asyncio.run(run())
+    results = {
+        "sessions": args.sessions,
+        "bytes per session": (opened - baseline) / args.sessions,
+        "wall s": timer.wall,
+        "cpu s": timer.cpu,
+        "turns per s": args.sessions * args.session_turns / timer.wall,
+    }
+    results.update(latency_stats("turn", turn_latencies))
+    return results
+
+SCENARIOS = {
+    "overhead": bench_overhead,
+    "summarization": bench_summarization,
+    "camel": bench_camel,
+    "dnd": bench_dnd,
+    "memory": bench_memory,
+    "sessions": bench_sessions,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline lloom benchmarks against a local mock server")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tokens-per-second", type=float, default=2000)
+    parser.add_argument("--response-words", type=int, default=50)
+    parser.add_argument("--error-429-rate", type=float, default=0.0)
+    parser.add_argument("--error-500-rate", type=float, default=0.0)
+    parser.add_argument("--pages", type=int, default=11)
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--history", type=int, default=200)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--session-turns", type=int, default=3)
+    parser.add_argument("--max-in-flight", type=int, default=100)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    process, url = start_server(args)
+    results = {}
+    try:
+        for name in args.scenarios:
+            print(f"\n{name}")
+            results[name] = SCENARIOS[name](url, args)
+            for metric, value in results[name].items():
+                print(f"  {metric:<32} {value:.3f}" if isinstance(value, float) else f"  {metric:<32} {value}")
+        results["server"] = server_stats(url)
+        print(f"\nserver requests {results['server']['requests']}, injected errors {results['server']['errors']}")
+    finally:
+        process.terminate()
+        process.wait()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Cold start benchmark: every run is a fresh interpreter that imports lloom, builds a client and sends two requests to the mock server,
+# with and without warmup, so import time and the cost the first request pays for loading the tokenizer and the HTTP client show up separately
+# Usage: python benchmarks/startup.py [--runs 10] [--model gpt-3.5-turbo-0613] [--json startup.json]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from mock_server import MockServer, MockSettings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import lloom
+imported = time.perf_counter()
+loom = lloom.Lloom(lloom.LloomConfig(api_key="benchmark", api_base={url!r}, model={model!r}, logging=False, warmup={warmup}))
+constructed = time.perf_counter()
+loom.generate("Hello!")
+first = time.perf_counter()
+loom.generate("Hello again!")
+second = time.perf_counter()
+print(json.dumps({{
+    "import ms": (imported - start) * 1000,
+    "construct ms": (constructed - imported) * 1000,
+    "first request ms": (first - constructed) * 1000,
+    "second request ms": (second - first) * 1000,
+    "import to first response ms": (first - start) * 1000,
+}}))
+"""
+
+def run_child(url, model, warmup):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", CHILD.format(root=ROOT, url=url, model=model, warmup=warmup)], capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    result["process ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and first request latency of lloom in fresh processes")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--model", default="gpt-3.5-turbo-0613")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with MockServer(settings=MockSettings(latency=args.latency, tokens_per_second=1e9)) as server:
+        for name, warmup in (("cold", False), ("warmup", True)):
+            runs = [run_child(server.url, args.model, warmup) for _ in range(args.runs)]
+            results[name] = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+            print(f"\n{name} (median of {args.runs} runs)")
+            for metric, value in results[name].items():
+                print(f"  {metric:<32} {value:.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
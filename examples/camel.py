@@ -78,7 +78,8 @@ print(f"Specified task prompt: {specified_task_msg}")
 chat_turn_limit, n = 30, 0
 while n < chat_turn_limit:
     n += 1
-    user_msg = user_agent.generate(assistant_msg)
+    # the stream is closed as soon as the sentinel shows up, so we don't pay for anything the model would add after it
+    user_msg = "".join(user_agent.generate_stream(assistant_msg, stop="<CAMEL_TASK_DONE>"))
     print(f"AI User ({user_role_name}):\n\n{user_msg}\n\n")
 
     assistant_msg = assistant_agent.generate(user_msg)
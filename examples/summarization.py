@@ -1,26 +1,18 @@
 from lloom import LloomConfig, Lloom
 from pypdf import PdfReader
-import re
 
 reader = PdfReader("virtual_injection.pdf")
 
 config = LloomConfig(api_key="", logging=False, model="gpt-3.5-turbo-0613")
 loom = Lloom(config=config)
 
-answers = []
+# A minimal helper to achieve a stuff chain. I know it's not exactly stuff chain as in Langchain documentation, but the concept is similar: putting the whole document into the prompt. I just split the PDF by pages
+# generate_many sends every page as an independent prompt against the current history, so the pages are summarized concurrently and the history of loom stays untouched
+# When the pages were summarized one by one, the code below took approximately 1.5 minutes to execute, as a result we got a list with gpt-generated summaries. I chose only 11 first pages, since the rest is examples and references
+answers = loom.generate_many([f"Write a concise summary of the following: {page.extract_text()}" for page in reader.pages[0:11]])
+answers = [answer for answer in answers if isinstance(answer, str)]
 
-# A minimal helper function to achieve a stuff chain. I know it's not exactly stuff chain as in Langchain documentation, but the concept is similar: putting the whole document into the prompt. I just split the PDF by pages
-def one_shot(text):
-    res = loom.generate(f"Write a concise summary of the following: {text}")
-    answers.append(res)
-    loom.clear_history()
-
-# The code below took approximately 1.5 minutes to execute, as a result we got a list with gpt-generated summaries. I chose only 11 first pages, since the rest is examples and references
-for page in reader.pages[0:11]:
-    text = page.extract_text()
-    one_shot(text)
-
-# This single line of code along with the function above implements a map-reduce chain
+# This single line of code along with the call above implements a map-reduce chain
 summary = loom.generate(f"Write a short and concise summary for these pieces of text: {', '.join(answers)}")
 
 print(summary) # it gave me this: 
@@ -69,11 +61,8 @@ The paper acknowledges the potential for misuse of the proposed technique and em
 The research references related works and highlights the importance of openly identifying and studying vulnerabilities in instruction-tuned LLMs to build safer models.
 '''
 
-rerank_answer = ""
-initial_score = 0
-
-def rerank(text):
-    res = loom.generate(f'''
+# The rerank prompt is the same for every page, compiling it once means only the page text is tokenized for each request
+rerank_template = loom.compile_template('''
                             Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
 
                             In addition to giving an answer, also return a score of how fully it answered the user's question. This should be in the following format:
@@ -127,23 +116,12 @@ def rerank(text):
                             Question: What is poisoning rate?
                             Helpful Answer:
 ''')
-    loom.clear_history()
-    return res
 
-for page in reader.pages[0:11]:
-    text = page.extract_text()
-    answer = rerank(text)
-    match = re.search(r'Score: (\d+)', answer)
-    if match:
-        answer_score = int(match.group(1))
-
-        if answer_score > initial_score:
-            initial_score = answer_score
-            rerank_answer = answer
-        else:
-            continue
-    else:
-        continue
+# best_of asks the question of every page concurrently and keeps the answer with the highest "Score: <number>". Once an answer
+# scores 100, the pages that weren't sent yet are skipped
+pages = [page.extract_text() for page in reader.pages[0:11]]
+best = loom.best_of(pages, rerank_template, threshold=100)
+rerank_answer = best[0][1] if best else ""
 
 print(rerank_answer)
 
@@ -1,13 +1,1807 @@
-from typing import List, Dict
+from __future__ import annotations
+from typing import List, Dict, Optional, Tuple, Union, Iterator, AsyncIterator, Iterable, Callable, Awaitable, TYPE_CHECKING
+# pydantic stays an eager import, the config models below are built on it when the module loads
 from pydantic import BaseModel, Field, ValidationError
-import requests
 import logging
-import tiktoken
 import time
 import json
+import threading
+import hashlib
+import random
+import re
+import contextlib
+import heapq
+import importlib
+import operator
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from collections.abc import MutableSequence
+from enum import Enum
+import weakref
+import copy
+import os
+import string
+from itertools import accumulate
+from array import array
+
+class _LazyModule:
+    # stands in for a module until one of its attributes is used, so `import lloom` doesn't pay for what a process never touches
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+if TYPE_CHECKING:
+    import asyncio
+    import sqlite3
+    import uuid
+    import requests
+    import tiktoken
+    import regex
+    from concurrent import futures
+    from email import utils as email_utils
+else:
+    asyncio = _LazyModule("asyncio")
+    sqlite3 = _LazyModule("sqlite3")
+    uuid = _LazyModule("uuid")
+    requests = _LazyModule("requests")
+    tiktoken = _LazyModule("tiktoken")
+    # tiktoken's own dependency, its split patterns use \p{...} classes that re doesn't support
+    regex = _LazyModule("regex")
+    futures = _LazyModule("concurrent.futures")
+    email_utils = _LazyModule("email.utils")
+
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_token_params: Dict[str, Optional[Tuple[tiktoken.Encoding, int, int]]] = {}
+
+def _count_texts(encoding: tiktoken.Encoding, texts: List[str], num_threads: int = 8, batch_size: int = 1024) -> array:
+    counts = array("I")
+    # encoded in slices, so only the counts of a large corpus are kept in memory and not its tokens
+    for start in range(0, len(texts), batch_size):
+        counts.extend(len(tokens) for tokens in encoding.encode_ordinary_batch(texts[start:start + batch_size], num_threads=num_threads))
+    return counts
+
+def _count_texts_worker(encoding_name: str, texts: List[str]) -> array:
+    # runs in a worker process, tiktoken caches the encoding there after the first chunk
+    return _count_texts(tiktoken.get_encoding(encoding_name), texts, num_threads=1)
+
+class LloomError(Exception):
+    pass
+
+class TokenLimitError(LloomError):
+    pass
+
+class BudgetExceededError(LloomError):
+    pass
+
+class CassetteMissError(LloomError):
+    pass
+
+class LloomAPIError(LloomError):
+    def __init__(self, message: str, status_code: Optional[int] = None, body: Optional[str] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+class HTTPTransport:
+    def __init__(self, pool_size: int = 10, timeout: Tuple[float, float] = (10, 600)):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        # created on first use, a process that only counts tokens never imports requests
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def post(self, url: str, headers: Dict[str, str], data: str, timeout: Optional[Tuple[float, float]] = None, stream: bool = False) -> requests.Response:
+        return self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout, stream=stream)
+
+    @property
+    def retryable_errors(self) -> Tuple[type, ...]:
+        return (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+_transports: Dict[int, HTTPTransport] = {}
+_transports_lock = threading.Lock()
+
+def get_transport(pool_size: int = 10) -> HTTPTransport:
+    # one keep-alive pool per size, shared by every instance that does not bring its own transport
+    with _transports_lock:
+        if pool_size not in _transports:
+            _transports[pool_size] = HTTPTransport(pool_size=pool_size)
+        return _transports[pool_size]
+
+class AsyncResponse:
+    def __init__(self, status_code: int, headers: Dict[str, str], content: bytes = b"", response=None, queue_wait: float = 0.0):
+        self.status_code = status_code
+        # aiohttp headers are case-insensitive, the copy is lowercased so lookups behave the same as with requests
+        self.headers = {k.lower(): v for k, v in headers.items()}
+        self.content = content
+        self._response = response
+        # how long the request waited for a slot in the transport before it went out
+        self.queue_wait = queue_wait
+
+    def json(self) -> Dict:
+        return json.loads(self.content)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(errors="replace")
+
+    async def read(self) -> bytes:
+        if self._response is not None:
+            self.content = await self._response.read()
+        return self.content
+
+    def iter_lines(self) -> AsyncIterator[bytes]:
+        if self._response is None:
+            return self._iter_content_lines()
+        return self._response.content
+
+    async def _iter_content_lines(self) -> AsyncIterator[bytes]:
+        for line in self.content.splitlines():
+            yield line
+
+class AsyncHTTPTransport:
+    def __init__(self, max_concurrency: int = 100, timeout: Tuple[float, float] = (10, 600)):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        # aiohttp sessions and asyncio semaphores belong to the loop they were first used on. They hold on to that loop,
+        # so the entries never go away by themselves and are removed when the loop shuts down or on close()
+        self._sessions: Dict[asyncio.AbstractEventLoop, Tuple["aiohttp.ClientSession", asyncio.Semaphore, AsyncIterator[None]]] = {}
+
+    async def _get_session(self) -> Tuple["aiohttp.ClientSession", asyncio.Semaphore]:
+        try:
+            import aiohttp
+        except ImportError as e:
+            raise ImportError("aiohttp is required for the async API, install it with `pip install aiohttp`") from e
+        loop = asyncio.get_running_loop()
+        state = self._sessions.get(loop)
+        if state is None or state[0].closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+            keeper = self._keep(session)
+            await keeper.__anext__()
+            state = self._sessions[loop] = (session, asyncio.Semaphore(self.max_concurrency), keeper)
+        return state[0], state[1]
+
+    async def _keep(self, session: "aiohttp.ClientSession") -> AsyncIterator[None]:
+        # asyncio.run() closes the async generators that are still suspended when the loop shuts down, so this one closes
+        # the session together with its loop instead of leaving open sockets to the garbage collector
+        try:
+            yield
+        finally:
+            loop = asyncio.get_running_loop()
+            if self._sessions.get(loop, (None,))[0] is session:
+                del self._sessions[loop]
+            await session.close()
+
+    async def post(self, url: str, headers: Dict[str, str], data: str, timeout: Optional[Tuple[float, float]] = None) -> AsyncResponse:
+        import aiohttp
+        session, semaphore = await self._get_session()
+        connect_timeout, read_timeout = timeout or self.timeout
+        waiting = time.perf_counter()
+        async with semaphore:
+            queue_wait = time.perf_counter() - waiting
+            async with session.post(url, headers=headers, data=data, timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)) as response:
+                content = await response.read()
+                return AsyncResponse(response.status, dict(response.headers), content, queue_wait=queue_wait)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, url: str, headers: Dict[str, str], data: str, timeout: Optional[Tuple[float, float]] = None) -> AsyncIterator[AsyncResponse]:
+        import aiohttp
+        session, semaphore = await self._get_session()
+        connect_timeout, read_timeout = timeout or self.timeout
+        waiting = time.perf_counter()
+        async with semaphore:
+            queue_wait = time.perf_counter() - waiting
+            async with session.post(url, headers=headers, data=data, timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)) as response:
+                yield AsyncResponse(response.status, dict(response.headers), response=response, queue_wait=queue_wait)
+
+    @property
+    def retryable_errors(self) -> Tuple[type, ...]:
+        import aiohttp
+        return (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+    async def close(self):
+        state = self._sessions.get(asyncio.get_running_loop())
+        if state is not None:
+            await state[2].aclose()
+
+_async_transports: Dict[int, AsyncHTTPTransport] = {}
+
+def get_async_transport(max_concurrency: int = 100) -> AsyncHTTPTransport:
+    with _transports_lock:
+        if max_concurrency not in _async_transports:
+            _async_transports[max_concurrency] = AsyncHTTPTransport(max_concurrency=max_concurrency)
+        return _async_transports[max_concurrency]
+
+class Cassette:
+    # recorded responses in a file with one "<request hash>\t<json>" line each, opening it only builds a hash -> offset index
+    # and replaying a request reads a single line. The hash covers the url and the body, never the headers with the API key
+    modes = ("replay", "record", "auto")
+
+    def __init__(self, path: str, mode: str = "auto", latency: float = 0.0, recorded_latency: bool = False):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        # replay never touches the network, record always does, auto replays what it has and records the rest
+        self.mode = mode
+        self.latency = latency
+        self.recorded_latency = recorded_latency
+        self.hits = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._file = open(path, "rb" if mode == "replay" else "a+b")
+        self._file.seek(0)
+        offset = 0
+        for line in self._file:
+            self._index[line[:64].decode()] = (offset, len(line))
+            offset += len(line)
+
+    @staticmethod
+    def make_key(url: str, body: str) -> str:
+        return hashlib.sha256(f"{url}\n{body}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[int, bytes, float]]:
+        # the status code, the body and how long to wait before handing it out, None when the request has to go out
+        entry = self._index.get(key) if self.mode != "record" else None
+        if entry is None:
+            if self.mode == "replay":
+                raise CassetteMissError(f"No recorded response for request {key} in {self.path}")
+            return None
+        with self._lock:
+            self._file.seek(entry[0])
+            line = self._file.read(entry[1])
+            self.hits += 1
+        recorded = json.loads(line[65:])
+        delay = self.latency + (recorded["elapsed"] if self.recorded_latency else 0.0)
+        return recorded["status"], recorded["body"].encode(), delay
+
+    def put(self, key: str, status_code: int, content: bytes, elapsed: float):
+        # rate limit headers aren't kept, they described the quota left at recording time
+        line = f"{key}\t{json.dumps({'status': status_code, 'elapsed': round(elapsed, 4), 'body': content.decode()})}\n".encode()
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(line)
+            self._file.flush()
+            self._index[key] = (offset, len(line))
+            self.recorded += 1
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def close(self):
+        self._file.close()
+
+class CassetteResponse:
+    # stands in for requests.Response, with the parts of it Lloom reads
+    def __init__(self, status_code: int, headers: Dict[str, str], content: bytes):
+        self.status_code = status_code
+        self.headers = {k.lower(): v for k, v in headers.items()}
+        self.content = content
+
+    def json(self) -> Dict:
+        return json.loads(self.content)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(errors="replace")
+
+    def iter_lines(self) -> Iterator[bytes]:
+        return iter(self.content.splitlines())
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> "CassetteResponse":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class CassetteTransport:
+    # a drop-in for HTTPTransport that answers from a cassette and records through a real transport
+    def __init__(self, cassette: Cassette, transport: Optional[HTTPTransport] = None):
+        self.cassette = cassette
+        self.transport = transport or get_transport()
+
+    @property
+    def session(self) -> requests.Session:
+        return self.transport.session
+
+    def post(self, url: str, headers: Dict[str, str], data: str, timeout: Optional[Tuple[float, float]] = None, stream: bool = False) -> CassetteResponse:
+        key = self.cassette.make_key(url, data)
+        recorded = self.cassette.get(key)
+        if recorded is not None:
+            status_code, content, delay = recorded
+            if delay:
+                time.sleep(delay)
+            return CassetteResponse(status_code, {}, content)
+        start = time.perf_counter()
+        # a recorded stream is read to the end before it is passed on, the whole of it goes into the cassette
+        with self.transport.post(url, headers, data, timeout, stream) as response:
+            content = response.content
+        if response.status_code < 400:
+            self.cassette.put(key, response.status_code, content, time.perf_counter() - start)
+        return CassetteResponse(response.status_code, dict(response.headers), content)
+
+    @property
+    def retryable_errors(self) -> Tuple[type, ...]:
+        return self.transport.retryable_errors
+
+    def close(self):
+        self.cassette.close()
+
+class AsyncCassetteTransport:
+    # the AsyncHTTPTransport counterpart of CassetteTransport, both can share one cassette
+    def __init__(self, cassette: Cassette, transport: Optional[AsyncHTTPTransport] = None):
+        self.cassette = cassette
+        self.transport = transport or get_async_transport()
+
+    async def post(self, url: str, headers: Dict[str, str], data: str, timeout: Optional[Tuple[float, float]] = None) -> AsyncResponse:
+        key = self.cassette.make_key(url, data)
+        recorded = self.cassette.get(key)
+        if recorded is not None:
+            status_code, content, delay = recorded
+            if delay:
+                await asyncio.sleep(delay)
+            return AsyncResponse(status_code, {}, content)
+        start = time.perf_counter()
+        response = await self.transport.post(url, headers, data, timeout)
+        if response.status_code < 400:
+            self.cassette.put(key, response.status_code, response.content, time.perf_counter() - start - response.queue_wait)
+        return response
+
+    @contextlib.asynccontextmanager
+    async def stream(self, url: str, headers: Dict[str, str], data: str, timeout: Optional[Tuple[float, float]] = None) -> AsyncIterator[AsyncResponse]:
+        key = self.cassette.make_key(url, data)
+        recorded = self.cassette.get(key)
+        if recorded is not None:
+            status_code, content, delay = recorded
+            if delay:
+                await asyncio.sleep(delay)
+            yield AsyncResponse(status_code, {}, content)
+            return
+        start = time.perf_counter()
+        async with self.transport.stream(url, headers, data, timeout) as response:
+            content = await response.read()
+        if response.status_code < 400:
+            self.cassette.put(key, response.status_code, content, time.perf_counter() - start - response.queue_wait)
+        yield AsyncResponse(response.status_code, response.headers, content, queue_wait=response.queue_wait)
+
+    @property
+    def retryable_errors(self) -> Tuple[type, ...]:
+        return self.transport.retryable_errors
+
+    async def close(self):
+        self.cassette.close()
+
+class RetryPolicy:
+    def __init__(self, max_retries: int = 5, backoff_base: float = 1.0, max_backoff: float = 60.0, jitter: bool = True, retry_statuses: Tuple[int, ...] = (408, 409, 429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+
+    def get_delay(self, attempt: int, headers: Optional[Dict[str, str]] = None) -> float:
+        retry_after = _parse_retry_after(headers or {})
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        delay = min(self.max_backoff, self.backoff_base * 2 ** attempt)
+        # full jitter keeps the clients that were throttled together from retrying together
+        return random.uniform(0, delay) if self.jitter else delay
+
+def _parse_retry_after(headers: Dict[str, str]) -> Optional[float]:
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email_utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    # OpenAI reports resets as durations such as "20ms", "1s" or "6m0s"
+    if not value:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+class RateLimiter:
+    def __init__(self, max_concurrency: int = 100):
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self._paused_until = 0.0
+        self._next_request_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> float:
+        # returns 0 when the request may be sent right away, otherwise how long to wait before asking again
+        with self._lock:
+            now = time.time()
+            if self.in_flight >= int(self.concurrency_limit):
+                return 0.05
+            start_at = max(now, self._paused_until, self._next_request_at)
+            if self.remaining_requests is not None and self.requests_reset_at > now and self.remaining_requests <= 0:
+                start_at = max(start_at, self.requests_reset_at)
+            if self.remaining_tokens is not None and self.tokens_reset_at > now and self.remaining_tokens < tokens:
+                start_at = max(start_at, self.tokens_reset_at)
+            if start_at > now:
+                return start_at - now
+            if self.remaining_requests is not None and self.requests_reset_at > now:
+                # spread what is left of the quota evenly over the time until it resets
+                self._next_request_at = now + (self.requests_reset_at - now) / max(self.remaining_requests, 1)
+                self.remaining_requests -= 1
+            if self.remaining_tokens is not None and self.tokens_reset_at > now:
+                self.remaining_tokens -= tokens
+            self.in_flight += 1
+            return 0.0
+
+    def release(self, status_code: Optional[int] = None, headers: Optional[Dict[str, str]] = None):
+        headers = headers or {}
+        with self._lock:
+            now = time.time()
+            self.in_flight = max(0, self.in_flight - 1)
+            if status_code == 429:
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+            elif status_code is not None and status_code < 400:
+                self.concurrency_limit = min(float(self.max_concurrency), self.concurrency_limit + 1 / self.concurrency_limit)
+            remaining_requests = headers.get("x-ratelimit-remaining-requests")
+            if remaining_requests is not None:
+                self.remaining_requests = int(remaining_requests)
+                self.requests_reset_at = now + (_parse_duration(headers.get("x-ratelimit-reset-requests")) or 1.0)
+            remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+            if remaining_tokens is not None:
+                self.remaining_tokens = int(remaining_tokens)
+                self.tokens_reset_at = now + (_parse_duration(headers.get("x-ratelimit-reset-tokens")) or 1.0)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+
+def get_rate_limiter(api_key: str, max_concurrency: int = 100) -> RateLimiter:
+    # quotas belong to the key, so every instance using the same key shares one limiter
+    key = hashlib.sha256(api_key.encode()).hexdigest()
+    with _transports_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(max_concurrency=max_concurrency)
+        return _rate_limiters[key]
+
+def _estimate_request_tokens(data: Dict) -> int:
+    # the same estimate the API uses for rate limiting: roughly 4 characters per token plus max_tokens
+    return sum(len(message["content"]) for message in data["messages"]) // 4 + data["max_tokens"]
+
+def _encode_request(data: Dict) -> str:
+    # history messages are spliced in as the JSON they cached the first time they were sent, so a request only encodes its new turns
+    fields = json.dumps({key: value for key, value in data.items() if key != "messages"})
+    messages = ", ".join(message.to_json() if isinstance(message, Message) else json.dumps(message) for message in data["messages"])
+    return f'{{"messages": [{messages}]' + (", " + fields[1:] if len(fields) > 2 else "}")
+
+class SQLiteCacheBackend:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, created REAL, value TEXT)")
+        self._connection.commit()
+
+    def get(self, key: str) -> Optional[Tuple[float, Dict]]:
+        with self._lock:
+            row = self._connection.execute("SELECT created, value FROM completions WHERE key = ?", (key,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def set(self, key: str, created: float, value: Dict):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?)", (key, created, json.dumps(value)))
+            self._connection.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM completions")
+            self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+class ResponseCache:
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None, backend: Optional[SQLiteCacheBackend] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(url: str, data: Dict) -> str:
+        # the url carries the Azure deployment, the payload carries the model, messages and sampling parameters
+        return hashlib.sha256(f"{url}\n{_encode_request(data)}".encode()).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+        if self.backend is None:
+            return None
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry[0]):
+            self.backend.delete(key)
+            return None
+        self._remember(key, entry)
+        return entry[1]
+
+    def set(self, key: str, value: Dict):
+        created = time.time()
+        self._remember(key, (created, value))
+        if self.backend is not None:
+            self.backend.set(key, created, value)
+
+    def _remember(self, key: str, entry: Tuple[float, Dict]):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+_MINHASH_MIX = 0x9E3779B97F4A7C15
+_MINHASH_EMPTY = (1 << 64) - 1
+
+def _normalize_prompt(text: str) -> str:
+    return " ".join(text.lower().split())
+
+class SimilarPromptCache:
+    # answers a prompt with the completion of an earlier one that is nearly the same, for the same url, model, sampling
+    # parameters and conversation before it. Prompts are compared by MinHash over shingles of their tokens, with one hash
+    # per shingle spread over num_perm bins rather than num_perm hashes, and an LSH index over bands of the signatures finds
+    # the candidates without looking at the other entries
+    def __init__(self, threshold: float = 0.8, max_size: int = 10_000, num_perm: int = 64, shingle_size: int = 3, normalize: Callable[[str], str] = _normalize_prompt):
+        if not 0 < threshold <= 1:
+            raise ValueError(f"The similarity threshold has to be in (0, 1], got {threshold}")
+        self.threshold = threshold
+        self.max_size = max_size
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.normalize = normalize
+        # the longest bands that still make a pair at the threshold a candidate 98% of the time, longer bands mean fewer
+        # candidates to check. Low thresholds can't get there at all, single-row bands are as close as it gets
+        self.rows = next((rows for rows in range(num_perm, 0, -1) if num_perm % rows == 0 and 1 - (1 - threshold ** rows) ** (num_perm // rows) >= 0.98), 1)
+        self.bands = num_perm // self.rows
+        # random rather than the next bin over, neighbours borrowing the same value would make a whole band match on one
+        # common shingle
+        shuffler = random.Random(num_perm)
+        self._probes = [shuffler.sample([i for i in range(num_perm) if i != j], num_perm - 1) for j in range(num_perm)]
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        # band key -> entry id, or a list of them once a bucket is shared
+        self._buckets: Dict[int, Union[int, List[int]]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def signature(self, text: str, encoding: tiktoken.Encoding) -> array:
+        tokens = encoding.encode_ordinary(self.normalize(text))
+        size = self.num_perm
+        bins = [_MINHASH_EMPTY] * size
+        shingles = zip(*(tokens[i:] for i in range(self.shingle_size))) if len(tokens) >= self.shingle_size else [tuple(tokens)]
+        for shingle in shingles:
+            value = hash(shingle) * _MINHASH_MIX & _MINHASH_EMPTY
+            i = value * size >> 64
+            if value < bins[i]:
+                bins[i] = value
+        if tokens and _MINHASH_EMPTY in bins:
+            # short prompts leave bins empty, each one borrows from the first filled bin in its own fixed order
+            filled = bins[:]
+            for j, value in enumerate(filled):
+                if value == _MINHASH_EMPTY:
+                    bins[j] = next(filled[i] for i in self._probes[j] if filled[i] != _MINHASH_EMPTY)
+        return array("Q", bins)
+
+    def _band_keys(self, scope: str, signature: array) -> List[int]:
+        rows = self.rows
+        return [hash((scope, band, *signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def similarity(self, first: array, second: array) -> float:
+        return sum(map(operator.eq, first, second)) / self.num_perm
+
+    def get(self, scope: str, signature: array) -> Optional[Dict]:
+        keys = self._band_keys(scope, signature)
+        with self._lock:
+            best, best_similarity = None, self.threshold
+            checked = set()
+            for key in keys:
+                bucket = self._buckets.get(key)
+                for entry_id in (bucket if isinstance(bucket, list) else () if bucket is None else (bucket,)):
+                    if entry_id in checked:
+                        continue
+                    checked.add(entry_id)
+                    entry_scope, entry_signature, _ = self._entries[entry_id]
+                    if entry_scope == scope:
+                        similarity = self.similarity(signature, entry_signature)
+                        if similarity >= best_similarity and (best is None or similarity > best_similarity):
+                            best, best_similarity = entry_id, similarity
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return self._entries[best][2]
+
+    def set(self, scope: str, signature: array, value: Dict):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, signature, value)
+            for key in self._band_keys(scope, signature):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    self._buckets[key] = entry_id
+                elif isinstance(bucket, list):
+                    bucket.append(entry_id)
+                else:
+                    self._buckets[key] = [bucket, entry_id]
+            while len(self._entries) > self.max_size:
+                self._forget(*self._entries.popitem(last=False))
+
+    def _forget(self, entry_id: int, entry: Tuple[str, array, Dict]):
+        for key in self._band_keys(entry[0], entry[1]):
+            bucket = self._buckets.get(key)
+            if isinstance(bucket, list):
+                bucket.remove(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[key] = bucket[0]
+            elif bucket == entry_id:
+                del self._buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SingleFlight:
+    # identical requests that are in flight at the same time share one upstream call, keyed like the response cache
+    def __init__(self):
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._calls: Dict[str, futures.Future] = {}
+        self._async_calls = weakref.WeakKeyDictionary()
+
+    def do(self, key: str, fn: Callable[[], Dict]) -> Tuple[Dict, bool]:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = futures.Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return call.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Dict]]) -> Tuple[Dict, bool]:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            calls = self._async_calls.setdefault(loop, {})
+            task = calls.get(key)
+            leader = task is None
+            if leader:
+                task = calls[key] = loop.create_task(fn())
+                task.add_done_callback(lambda _: calls.pop(key, None))
+            else:
+                self.shared += 1
+        # shielded, so one caller giving up doesn't cancel the request for everyone else waiting on it
+        result = await asyncio.shield(task)
+        return result, not leader
+
+def _grant(future: "asyncio.Future"):
+    if not future.done():
+        future.set_result(None)
+
+class FairSemaphore:
+    # a semaphore for threads and asyncio tasks alike that hands out its slots strictly in the order they were asked for
+    def __init__(self, value: int = 1):
+        self.value = value
+        self.in_use = 0
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.in_use < self.value and not self._waiters:
+                self.in_use += 1
+                return
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+        # a released slot is handed straight to the first waiter, in_use stays the same
+        waiter.acquire()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.in_use < self.value and not self._waiters:
+                self.in_use += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # the slot was handed over just as the task was cancelled, so it goes on to the next waiter
+            self.release()
+            raise
+
+    def release(self):
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self.in_use -= 1
+                    return
+                waiter = self._waiters.popleft()
+            if not isinstance(waiter, tuple):
+                waiter.release()
+                return
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(_grant, future)
+                return
+            except RuntimeError:
+                # the waiter's event loop is closed
+                continue
+
+    def __enter__(self) -> "FairSemaphore":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self) -> "FairSemaphore":
+        await self.aacquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+def _parse_stream_line(line: bytes) -> Tuple[bool, Optional[str]]:
+    # server-sent events: every chunk is a "data: {...}" line and the stream ends with "data: [DONE]"
+    line = line.strip()
+    if not line.startswith(b"data:"):
+        return False, None
+    payload = line[5:].strip()
+    if payload == b"[DONE]":
+        return True, None
+    choices = json.loads(payload).get("choices")
+    if not choices:
+        return False, None
+    return False, choices[0].get("delta", {}).get("content")
+
+class _StopDetector:
+    def __init__(self, stop: Optional[Union[str, List[str]]]):
+        self.stops = [stop] if isinstance(stop, str) else list(stop or [])
+        self.keep = max((len(s) for s in self.stops), default=1) - 1
+        self.tail = ""
+
+    def feed(self, delta: str) -> Tuple[str, bool]:
+        # a sentinel can be split across several deltas, so the end of the previous text is searched as well
+        if not self.stops:
+            return delta, False
+        window = self.tail + delta
+        found = [window.find(s) + len(s) for s in self.stops if s in window]
+        if found:
+            return delta[:min(found) - len(self.tail)], True
+        self.tail = window[-self.keep:] if self.keep else ""
+        return delta, False
+
+class Role(str, Enum):
+    SYSTEM = "system"
+    USER = "user"
+    ASSISTANT = "assistant"
+    FUNCTION = "function"
+    TOOL = "tool"
+
+class Message:
+    # a history entry that reads like the {"role", "content"} dict it replaces, it is never edited once created,
+    # so its token count and its encoded JSON are worked out once and kept with it
+    __slots__ = ("role", "content", "name", "tokens", "_json")
+
+    def __init__(self, role: Union[Role, str], content: str, name: Optional[str] = None, tokens: int = 0):
+        self.role = Role(role)
+        self.content = content
+        self.name = name
+        self.tokens = tokens
+        self._json: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, message: Dict[str, str], tokens: int = 0) -> "Message":
+        return cls(message["role"], message["content"], message.get("name"), tokens)
+
+    @classmethod
+    def from_json(cls, encoded: str, tokens: int = 0) -> "Message":
+        message = cls.from_dict(json.loads(encoded), tokens)
+        message._json = encoded
+        return message
+
+    def to_dict(self) -> Dict[str, str]:
+        # _value_ is the plain attribute behind Enum.value, which goes through a much slower descriptor
+        message = {"role": self.role._value_, "content": self.content}
+        if self.name is not None:
+            message["name"] = self.name
+        return message
+
+    def to_json(self) -> str:
+        if self._json is None:
+            self._json = json.dumps(self.to_dict())
+        return self._json
+
+    def __getitem__(self, key: str) -> str:
+        if key == "role":
+            return self.role._value_
+        if key == "content":
+            return self.content
+        if key == "name" and self.name is not None:
+            return self.name
+        raise KeyError(key)
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> Iterable[str]:
+        return self.to_dict().keys()
+
+    def items(self) -> Iterable[Tuple[str, str]]:
+        return self.to_dict().items()
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (Message, dict)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, Message) else other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+class ConversationHistory:
+    __slots__ = ("_base", "_base_length", "_depth", "_messages", "total_tokens")
+
+    def __init__(self, messages: Optional[List[Message]] = None):
+        # a history is a chain of frozen segments shared with its forks plus a tail that only this history appends to
+        self._base: Optional[ConversationHistory] = None
+        self._base_length = 0
+        self._depth = 0
+        self._messages: List[Message] = list(messages or [])
+        self.total_tokens = sum(message.tokens for message in self._messages)
+
+    def __len__(self) -> int:
+        return self._base_length + len(self._messages)
+
+    def _segments(self) -> List["ConversationHistory"]:
+        segments = []
+        node = self
+        while node is not None:
+            segments.append(node)
+            node = node._base
+        segments.reverse()
+        return segments
+
+    def __iter__(self) -> Iterator[Message]:
+        for segment in self._segments():
+            yield from segment._messages
+
+    def __getitem__(self, index: int) -> Message:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        node = self
+        while index < node._base_length:
+            node = node._base
+        return node._messages[index - node._base_length]
+
+    def to_list(self) -> List[Message]:
+        return [message for segment in self._segments() for message in segment._messages]
+
+    def token_list(self) -> List[int]:
+        return [message.tokens for segment in self._segments() for message in segment._messages]
+
+    def select(self, indices: List[int]) -> List[Message]:
+        messages = self.to_list()
+        return messages if len(indices) == len(messages) else [messages[i] for i in indices]
+
+    def pinned_flags(self, pinned_ids: Dict[int, Message]) -> List[bool]:
+        # member lookups on an Enum class are slow, so it is looked up once rather than per message
+        system = Role.SYSTEM
+        return [message.role is system or id(message) in pinned_ids for message in self]
+
+    def pin(self, index: int) -> Message:
+        return self[index]
+
+    def unpin(self, index: int) -> Message:
+        return self[index]
+
+    def append(self, message: Message):
+        self._messages.append(message)
+        self.total_tokens += message.tokens
+
+    def _detach(self):
+        # copy-on-write: editing the shared part of the history gives this history its own copy first
+        if self._base is not None:
+            self._messages = self.to_list()
+            self._base = None
+            self._base_length = 0
+            self._depth = 0
+
+    def replace(self, index: int, message: Message):
+        if index < self._base_length:
+            self._detach()
+        index -= self._base_length
+        self.total_tokens += message.tokens - self._messages[index].tokens
+        self._messages[index] = message
+
+    def prepend(self, message: Message):
+        self._detach()
+        self._messages.insert(0, message)
+        self.total_tokens += message.tokens
+
+    def retain(self, indices: List[int]):
+        messages = self.to_list()
+        self._base = None
+        self._base_length = 0
+        self._depth = 0
+        self._messages = [messages[i] for i in indices]
+        self.total_tokens = sum(message.tokens for message in self._messages)
+
+    def fork(self) -> "ConversationHistory":
+        if self._messages:
+            frozen = ConversationHistory()
+            frozen._base, frozen._base_length, frozen._depth = self._base, self._base_length, self._depth
+            frozen._messages = self._messages
+            frozen.total_tokens = self.total_tokens
+            if frozen._depth >= 32:
+                # long chains of forks of forks are flattened once so lookups don't walk them every time
+                frozen._detach()
+            self._base, self._base_length, self._depth = frozen, len(frozen), frozen._depth + 1
+            self._messages = []
+        child = ConversationHistory()
+        child._base, child._base_length, child._depth = self._base, self._base_length, self._depth
+        child.total_tokens = self.total_tokens
+        return child
+
+class HistoryStore(ABC):
+    # sessions are lists of messages with their token counts, positions start at 0 and have no gaps
+    @abstractmethod
+    def index(self, session_id: str) -> List[Tuple[str, int]]:
+        # the role and the token count of every message, without loading the messages themselves
+        raise NotImplementedError
+
+    @abstractmethod
+    def load(self, session_id: str, start: int, end: int) -> List[Message]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def append(self, session_id: str, position: int, message: Message):
+        raise NotImplementedError
+
+    @abstractmethod
+    def replace(self, session_id: str, position: int, message: Message):
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert(self, session_id: str, position: int, message: Message):
+        raise NotImplementedError
+
+    @abstractmethod
+    def retain(self, session_id: str, positions: List[int]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def copy(self, source_id: str, target_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def sessions(self) -> List[str]:
+        raise NotImplementedError
+
+class MemoryHistoryStore(HistoryStore):
+    def __init__(self):
+        self._sessions: Dict[str, List[Message]] = {}
+        self._lock = threading.Lock()
+
+    def index(self, session_id: str) -> List[Tuple[str, int]]:
+        with self._lock:
+            return [(message.role.value, message.tokens) for message in self._sessions.get(session_id, [])]
+
+    def load(self, session_id: str, start: int, end: int) -> List[Message]:
+        with self._lock:
+            return self._sessions.get(session_id, [])[start:end]
+
+    def append(self, session_id: str, position: int, message: Message):
+        with self._lock:
+            self._sessions.setdefault(session_id, []).append(message)
+
+    def replace(self, session_id: str, position: int, message: Message):
+        with self._lock:
+            self._sessions[session_id][position] = message
+
+    def insert(self, session_id: str, position: int, message: Message):
+        with self._lock:
+            self._sessions.setdefault(session_id, []).insert(position, message)
+
+    def retain(self, session_id: str, positions: List[int]):
+        with self._lock:
+            entries = self._sessions.get(session_id, [])
+            self._sessions[session_id] = [entries[i] for i in positions]
+
+    def copy(self, source_id: str, target_id: str):
+        with self._lock:
+            self._sessions[target_id] = list(self._sessions.get(source_id, []))
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def sessions(self) -> List[str]:
+        with self._lock:
+            return list(self._sessions)
+
+class SQLiteHistoryStore(HistoryStore):
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # every turn is committed as it is added, WAL keeps those commits cheap
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS messages (session TEXT, position INTEGER, role TEXT, tokens INTEGER, message TEXT, PRIMARY KEY (session, position)) WITHOUT ROWID")
+        self._connection.commit()
+
+    def index(self, session_id: str) -> List[Tuple[str, int]]:
+        with self._lock:
+            return self._connection.execute("SELECT role, tokens FROM messages WHERE session = ? ORDER BY position", (session_id,)).fetchall()
+
+    def load(self, session_id: str, start: int, end: int) -> List[Message]:
+        with self._lock:
+            rows = self._connection.execute("SELECT message, tokens FROM messages WHERE session = ? AND position >= ? AND position < ? ORDER BY position", (session_id, start, end)).fetchall()
+        return [Message.from_json(encoded, tokens) for encoded, tokens in rows]
+
+    def append(self, session_id: str, position: int, message: Message):
+        with self._lock:
+            self._connection.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", (session_id, position, message.role.value, message.tokens, message.to_json()))
+            self._connection.commit()
+
+    def replace(self, session_id: str, position: int, message: Message):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", (session_id, position, message.role.value, message.tokens, message.to_json()))
+            self._connection.commit()
+
+    def insert(self, session_id: str, position: int, message: Message):
+        with self._lock, self._connection:
+            # shifted through negative positions, so the primary key never sees two rows at the same position
+            self._connection.execute("UPDATE messages SET position = -position - 1 WHERE session = ? AND position >= ?", (session_id, position))
+            self._connection.execute("UPDATE messages SET position = -position WHERE session = ? AND position < 0", (session_id,))
+            self._connection.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", (session_id, position, message.role.value, message.tokens, message.to_json()))
+
+    def retain(self, session_id: str, positions: List[int]):
+        with self._lock, self._connection:
+            kept = set(positions)
+            removed = [(session_id, i) for i, in self._connection.execute("SELECT position FROM messages WHERE session = ?", (session_id,)) if i not in kept]
+            self._connection.executemany("DELETE FROM messages WHERE session = ? AND position = ?", removed)
+            # positions only ever move down into slots that were deleted or already vacated
+            self._connection.executemany("UPDATE messages SET position = ? WHERE session = ? AND position = ?", [(new, session_id, old) for new, old in enumerate(sorted(kept)) if new != old])
+
+    def copy(self, source_id: str, target_id: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM messages WHERE session = ?", (target_id,))
+            self._connection.execute("INSERT INTO messages SELECT ?, position, role, tokens, message FROM messages WHERE session = ?", (target_id, source_id))
+
+    def delete(self, session_id: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM messages WHERE session = ?", (session_id,))
+
+    def sessions(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT DISTINCT session FROM messages")]
+
+    def close(self):
+        self._connection.close()
+
+class PersistentHistory:
+    # a drop-in for ConversationHistory that writes every turn through to a HistoryStore and only keeps the token counts,
+    # the newest hot_size messages and the system and pinned messages in memory, the rest is loaded when a request needs it
+    def __init__(self, store: HistoryStore, session_id: str, hot_size: int = 64):
+        self.store = store
+        self.session_id = session_id
+        self.hot_size = hot_size
+        index = store.index(session_id)
+        # stored token counts, reopening a session never tokenizes it again
+        self._tokens = array("I", (tokens for _, tokens in index))
+        self._system = bytearray(role == "system" for role, _ in index)
+        self.total_tokens = sum(self._tokens)
+        self._tail_start = max(0, len(index) - hot_size)
+        self._tail: List[Message] = store.load(session_id, self._tail_start, len(index))
+        self._resident: Dict[int, Message] = {}
+        system = [i for i in range(self._tail_start) if self._system[i]]
+        self._resident.update(zip(system, self._load(system)))
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def __iter__(self) -> Iterator[Message]:
+        return iter(self.to_list())
+
+    def __getitem__(self, index: int) -> Message:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self.select([index])[0]
+
+    def _load(self, positions: List[int]) -> List[Message]:
+        # the kept messages are mostly a few contiguous runs, each one comes back in a single range query
+        messages = []
+        run_start = 0
+        for i in range(1, len(positions) + 1):
+            if i == len(positions) or positions[i] != positions[i - 1] + 1:
+                messages.extend(self.store.load(self.session_id, positions[run_start], positions[i - 1] + 1))
+                run_start = i
+        return messages
+
+    def select(self, indices: Iterable[int]) -> List[Message]:
+        indices = list(indices)
+        cold = [i for i in indices if i < self._tail_start and i not in self._resident]
+        loaded = dict(zip(cold, self._load(cold)))
+        tail, tail_start, resident = self._tail, self._tail_start, self._resident
+        return [tail[i - tail_start] if i >= tail_start else resident.get(i) or loaded[i] for i in indices]
+
+    def to_list(self) -> List[Message]:
+        return self.select(range(len(self)))
+
+    def token_list(self) -> List[int]:
+        return self._tokens.tolist()
+
+    def pinned_flags(self, pinned_ids: Dict[int, Message]) -> List[bool]:
+        pinned = [bool(system) for system in self._system]
+        for i, message in self._resident.items():
+            pinned[i] = pinned[i] or id(message) in pinned_ids
+        for i, message in enumerate(self._tail, self._tail_start):
+            pinned[i] = pinned[i] or id(message) in pinned_ids
+        return pinned
+
+    def pin(self, index: int) -> Message:
+        # pinned messages stay in memory, their ids are what Lloom tracks
+        index %= len(self)
+        message = self[index]
+        if index < self._tail_start:
+            self._resident[index] = message
+        return message
+
+    def unpin(self, index: int) -> Message:
+        index %= len(self)
+        message = self[index]
+        if not self._system[index]:
+            self._resident.pop(index, None)
+        return message
+
+    def _trim_tail(self):
+        excess = len(self._tail) - self.hot_size
+        if excess > 0:
+            for i, message in enumerate(self._tail[:excess], self._tail_start):
+                if self._system[i]:
+                    self._resident[i] = message
+            del self._tail[:excess]
+            self._tail_start += excess
+
+    def append(self, message: Message):
+        self.store.append(self.session_id, len(self), message)
+        self._tokens.append(message.tokens)
+        self._system.append(message.role is Role.SYSTEM)
+        self.total_tokens += message.tokens
+        self._tail.append(message)
+        self._trim_tail()
+
+    def replace(self, index: int, message: Message):
+        self.store.replace(self.session_id, index, message)
+        self.total_tokens += message.tokens - self._tokens[index]
+        self._tokens[index] = message.tokens
+        self._system[index] = message.role is Role.SYSTEM
+        if index >= self._tail_start:
+            self._tail[index - self._tail_start] = message
+        elif index in self._resident or self._system[index]:
+            self._resident[index] = message
+
+    def prepend(self, message: Message):
+        self.store.insert(self.session_id, 0, message)
+        self._tokens.insert(0, message.tokens)
+        self._system.insert(0, message.role is Role.SYSTEM)
+        self.total_tokens += message.tokens
+        self._resident = {i + 1: resident for i, resident in self._resident.items()}
+        if self._tail_start == 0:
+            self._tail.insert(0, message)
+            self._trim_tail()
+        else:
+            self._tail_start += 1
+            self._resident[0] = message
+
+    def retain(self, indices: List[int]):
+        self.store.retain(self.session_id, indices)
+        tail = dict(enumerate(self._tail, self._tail_start))
+        self._tokens = array("I", (self._tokens[i] for i in indices))
+        self._system = bytearray(self._system[i] for i in indices)
+        self.total_tokens = sum(self._tokens)
+        # the tail is whatever survived of the old one, it grows back as new turns come in
+        self._tail = [tail[old] for old in indices if old in tail]
+        self._tail_start = len(indices) - len(self._tail)
+        self._resident = {new: self._resident[old] for new, old in enumerate(indices) if old in self._resident}
+
+    def reset(self, messages: List[Message]):
+        self.store.delete(self.session_id)
+        self._tokens, self._system, self._tail, self._tail_start, self._resident = array("I"), bytearray(), [], 0, {}
+        self.total_tokens = 0
+        for message in messages:
+            self.append(message)
+
+    def fork(self) -> "PersistentHistory":
+        # the fork is a new session in the same store, copied by the store itself, and it shares the messages held in memory
+        # so the pins made on the parent still apply
+        child = copy.copy(self)
+        child.session_id = f"{self.session_id}/{uuid.uuid4().hex[:12]}"
+        self.store.copy(self.session_id, child.session_id)
+        child._tokens = array("I", self._tokens)
+        child._system = bytearray(self._system)
+        child._tail = list(self._tail)
+        child._resident = dict(self._resident)
+        return child
+
+class _MessageDict(dict):
+    # one message of a MessageList as a plain dict, editing it writes a new message back in its place in the history
+    __slots__ = ("_client", "_index", "_message")
+
+    def __init__(self, client: "Lloom", index: int, message: Message):
+        super().__init__(message.to_dict())
+        self._client = client
+        self._index = index
+        self._message = message
+
+    def _write_back(self):
+        history = self._client.history
+        # the history may have changed since this dict was handed out, the message is looked up again if it moved
+        if not (self._index < len(history) and history[self._index] is self._message):
+            self._index = next((i for i, message in enumerate(history) if message is self._message), None)
+            if self._index is None:
+                raise ValueError("The message is no longer in the history")
+        self._message = self._client._replace_message(self._index, self._client._make_message(self["role"], self["content"], self.get("name")))
+
+    def __setitem__(self, key: str, value: str):
+        super().__setitem__(key, value)
+        self._write_back()
+
+    def __delitem__(self, key: str):
+        super().__delitem__(key)
+        self._write_back()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._write_back()
+
+    def pop(self, key: str, *default) -> str:
+        value = super().pop(key, *default)
+        self._write_back()
+        return value
+
+    def setdefault(self, key: str, default: Optional[str] = None) -> str:
+        value = super().setdefault(key, default)
+        self._write_back()
+        return value
+
+class MessageList(MutableSequence):
+    # a live view of a Lloom history that reads like the list of dicts it used to be, appends, deletes and edits made
+    # through it go to the history. list(...) makes a plain copy, e.g. for json.dumps
+    def __init__(self, client: "Lloom"):
+        self._client = client
+
+    def __len__(self) -> int:
+        return len(self._client.history)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        for i, message in enumerate(self._client.history):
+            yield _MessageDict(self._client, i, message)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Dict[str, str], List[Dict[str, str]]]:
+        history = self._client.history
+        if isinstance(index, slice):
+            return [_MessageDict(self._client, i, history[i]) for i in range(*index.indices(len(history)))]
+        if index < 0:
+            index += len(history)
+        return _MessageDict(self._client, index, history[index])
+
+    def __setitem__(self, index: Union[int, slice], value):
+        if isinstance(index, slice):
+            messages = self._client.history.to_list()
+            messages[index] = [self._client._to_message(message) for message in value]
+            self._client._replace_history(messages)
+            return
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        self._client._replace_message(index, self._client._to_message(value))
+
+    def __delitem__(self, index: Union[int, slice]):
+        kept = list(range(len(self)))
+        removed = kept[index] if isinstance(index, slice) else [kept[index]]
+        del kept[index]
+        for i in removed:
+            self._client._pinned.pop(id(self._client.history[i]), None)
+        self._client.history.retain(kept)
+
+    def insert(self, index: int, value: Dict[str, str]):
+        message = self._client._to_message(value)
+        if index >= len(self):
+            self._client._append_message(message)
+            return
+        messages = self._client.history.to_list()
+        messages.insert(index, message)
+        self._client._replace_history(messages)
+
+    def append(self, value: Dict[str, str]):
+        self._client._append_message(self._client._to_message(value))
+
+    def clear(self):
+        self._client._replace_history([])
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (list, MessageList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+class RenderedPrompt(str):
+    # a rendered template that carries its token count, so adding it to the history doesn't tokenize it again
+    def __new__(cls, text: str, tokens: int, encoding: str) -> "RenderedPrompt":
+        prompt = super().__new__(cls, text)
+        prompt.tokens = tokens
+        prompt.encoding = encoding
+        return prompt
+
+class PromptTemplate:
+    # the static text around the {placeholders} is split the way the tokenizer splits text before BPE, and every piece is
+    # counted once when the template is compiled. Tokens never cross those pieces, so rendering only tokenizes the values
+    # and the pieces around them that a value can change the split of
+    # a letter followed by whitespace always ends a piece in every tiktoken split pattern, whatever comes before or after,
+    # so the text up to the last such spot before a value is counted up front, and the scan for where the split lines up
+    # with the template again after a value starts at the last such spot inside the value
+    _anchor = None
+
+    def __init__(self, template: str, encoding: Union[str, tiktoken.Encoding] = "cl100k_base"):
+        self.template = template
+        self.encoding = tiktoken.get_encoding(encoding) if isinstance(encoding, str) else encoding
+        self._pattern = regex.compile(self.encoding._pat_str)
+        if PromptTemplate._anchor is None:
+            PromptTemplate._anchor = regex.compile(r"(?r)\p{L}(?=\s)")
+        self.variables: List[str] = []
+        self._statics = [""]
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            self._statics[-1] += literal
+            if field is None:
+                continue
+            if not field.isidentifier() or format_spec or conversion:
+                raise ValueError(f"Only plain {{name}} placeholders are supported, got {{{field}}}")
+            self.variables.append(field)
+            self._statics.append("")
+        self._pieces = [self._pattern.findall(static) for static in self._statics]
+        self._prefix = [list(accumulate((len(self.encoding.encode_ordinary(piece)) for piece in pieces), initial=0)) for pieces in self._pieces]
+        self.static_tokens = sum(prefix[-1] for prefix in self._prefix)
+        # the index of the piece after the last anchor of every static part, what follows it goes in with the next value
+        self._cuts = []
+        for static, pieces in zip(self._statics, self._pieces):
+            anchor = self._anchor.search(static)
+            offsets = list(accumulate(map(len, pieces), initial=0))
+            self._cuts.append(offsets.index(anchor.end()) if anchor else 0)
+
+    def _split_until(self, text: str, start: int, position: int) -> Optional[List[str]]:
+        # the pieces from start to position, or None if no piece ends exactly at position
+        pieces = []
+        if position == start:
+            return pieces
+        for match in self._pattern.finditer(text, start):
+            pieces.append(match.group())
+            if match.end() >= position:
+                return pieces if match.end() == position else None
+        return None
+
+    def count(self, values: List[str]) -> int:
+        # values in the order of self.variables
+        total = 0
+        window = ""
+        last = len(self._pieces) - 1
+        for i, (pieces, prefix, cut) in enumerate(zip(self._pieces, self._prefix, self._cuts)):
+            start = 0
+            if i:
+                window += values[i - 1]
+                anchor = self._anchor.search(window)
+                anchor = anchor.end() if anchor else 0
+                # the pieces after a value join the window until the split lines up with the template's own again
+                while start < len(pieces):
+                    window += pieces[start]
+                    position = len(window) - len(pieces[start])
+                    split = self._split_until(window, anchor, position)
+                    if split is not None:
+                        # whitespace at the end of a string splits differently than in front of text, so only the part
+                        # up to the anchor is tokenized as one string
+                        total += len(self.encoding.encode_ordinary(window[:anchor])) + sum(len(self.encoding.encode_ordinary(piece)) for piece in split)
+                        window = ""
+                        break
+                    start += 1
+                if window:
+                    continue
+            end = len(pieces) if i == last else max(start, cut)
+            total += prefix[end] - prefix[start]
+            window = "".join(pieces[end:])
+        if window:
+            total += len(self.encoding.encode_ordinary(window))
+        return total
+
+    def render(self, max_tokens: Optional[int] = None, overflow: str = "error", truncate: Optional[str] = None, **values) -> RenderedPrompt:
+        # over max_tokens, overflow="error" raises TokenLimitError and overflow="truncate" cuts the end off the truncate
+        # variable (the longest value by default) until the prompt fits
+        if overflow not in ("error", "truncate"):
+            raise ValueError(f"Unknown overflow mode: {overflow}")
+        ordered = [str(values[name]) for name in self.variables]
+        tokens = self.count(ordered)
+        if max_tokens is not None and tokens > max_tokens:
+            if overflow == "error" or not self.variables:
+                raise TokenLimitError(f"The prompt has {tokens} tokens, more than the {max_tokens} that fit")
+            name = truncate or max(self.variables, key=lambda variable: len(str(values[variable])))
+            slots = [i for i, variable in enumerate(self.variables) if variable == name]
+            encoded = self.encoding.encode_ordinary(ordered[slots[0]])
+            keep = len(encoded)
+            while tokens > max_tokens and keep:
+                keep = max(0, keep - -(-(tokens - max_tokens) // len(slots)))
+                # a cut can land inside a multi-byte character, its remains decode to U+FFFD
+                value = self.encoding.decode(encoded[:keep]).rstrip("\ufffd")
+                for i in slots:
+                    ordered[i] = value
+                tokens = self.count(ordered)
+            if tokens > max_tokens:
+                raise TokenLimitError(f"The prompt has {tokens} tokens even with {name} empty, more than the {max_tokens} that fit")
+        text = "".join(static + value for static, value in zip(self._statics, ordered + [""]))
+        return RenderedPrompt(text, tokens, self.encoding.name)
+
+class ContextPolicy(ABC):
+    @abstractmethod
+    def fit(self, messages: List[Dict[str, str]], message_tokens: List[int], pinned: List[bool], token_limit: int, max_tokens: int) -> Optional[Tuple[List[int], int]]:
+        # returns the indices of the messages to send and the completion budget, or None if nothing fits
+        raise NotImplementedError
+
+class TrimOldestPolicy(ContextPolicy):
+    def fit(self, messages: List[Dict[str, str]], message_tokens: List[int], pinned: List[bool], token_limit: int, max_tokens: int) -> Optional[Tuple[List[int], int]]:
+        # drops the oldest messages only while the prompt itself overflows, then gives the completion whatever is left
+        prompt_tokens = sum(message_tokens) + 3
+        dropped = [False] * len(messages)
+        for i, tokens in enumerate(message_tokens):
+            if prompt_tokens <= token_limit:
+                break
+            if not pinned[i]:
+                prompt_tokens -= tokens
+                dropped[i] = True
+        if prompt_tokens >= token_limit:
+            return None
+        return [i for i, drop in enumerate(dropped) if not drop], min(max_tokens, token_limit - prompt_tokens)
+
+class SlidingWindowPolicy(ContextPolicy):
+    def __init__(self, reserved_tokens: Optional[int] = None, max_messages: Optional[int] = None):
+        self.reserved_tokens = reserved_tokens
+        self.max_messages = max_messages
+
+    def fit(self, messages: List[Dict[str, str]], message_tokens: List[int], pinned: List[bool], token_limit: int, max_tokens: int) -> Optional[Tuple[List[int], int]]:
+        # keeps the pinned messages and as many of the newest ones as fit next to a fixed completion budget
+        reserved_tokens = self.reserved_tokens or max_tokens
+        available = token_limit - reserved_tokens - 3 - sum(tokens for tokens, pin in zip(message_tokens, pinned) if pin)
+        if available < 0:
+            return None
+        window: List[int] = []
+        for i in range(len(messages) - 1, -1, -1):
+            if pinned[i]:
+                continue
+            if message_tokens[i] > available or (self.max_messages is not None and len(window) >= self.max_messages):
+                break
+            available -= message_tokens[i]
+            window.append(i)
+        window.reverse()
+        # a window that starts with an answer has lost the question, so it starts at the next user turn instead
+        start = 0
+        while start < len(window) and messages[window[start]]["role"] == "assistant":
+            start += 1
+        in_window = [False] * len(messages)
+        for i in window[start:]:
+            in_window[i] = True
+        kept = [i for i in range(len(messages)) if pinned[i] or in_window[i]]
+        prompt_tokens = sum(message_tokens[i] for i in kept) + 3
+        return kept, min(max_tokens, token_limit - prompt_tokens)
+
+class RequestMetrics:
+    __slots__ = ("model", "stream", "prompt_tokens", "completion_tokens", "tokenization_time", "queue_wait", "network_time", "first_token_time", "total_time", "retries", "cache_hit", "coalesced", "status_code", "error", "_start", "_reserved", "_sent")
+
+    def __init__(self, model: str, stream: bool = False):
+        self.model = model
+        self.stream = stream
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        self.tokenization_time = 0.0
+        self.queue_wait = 0.0
+        self.network_time = 0.0
+        self.first_token_time: Optional[float] = None
+        self.total_time = 0.0
+        self.retries = 0
+        self.cache_hit = False
+        self.coalesced = False
+        self.status_code: Optional[int] = None
+        self.error: Optional[str] = None
+        self._start = time.perf_counter()
+        # the (prompt tokens, max_tokens) this request holds in the token budget until it is settled
+        self._reserved: Optional[Tuple[int, int]] = None
+        # set while an async request is out and no response has come back, the caller may stop waiting on it meanwhile
+        self._sent = False
+
+    def as_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__ if not name.startswith("_")}
+
+    def __repr__(self) -> str:
+        # only ever built when a log record is actually emitted
+        return "RequestMetrics(" + ", ".join(f"{k}={v!r}" for k, v in self.as_dict().items()) + ")"
+
+class MetricsCollector:
+    # pass an instance as on_request to aggregate over many requests, read it with snapshot()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.totals = {"requests": 0, "errors": 0, "cache_hits": 0, "coalesced": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0, "tokenization_time": 0.0, "queue_wait": 0.0, "network_time": 0.0, "total_time": 0.0}
+
+    def __call__(self, metrics: RequestMetrics):
+        with self._lock:
+            totals = self.totals
+            totals["requests"] += 1
+            totals["errors"] += metrics.error is not None
+            totals["cache_hits"] += metrics.cache_hit
+            totals["coalesced"] += metrics.coalesced
+            totals["retries"] += metrics.retries
+            totals["prompt_tokens"] += metrics.prompt_tokens or 0
+            totals["completion_tokens"] += metrics.completion_tokens or 0
+            totals["tokenization_time"] += metrics.tokenization_time
+            totals["queue_wait"] += metrics.queue_wait
+            totals["network_time"] += metrics.network_time
+            totals["total_time"] += metrics.total_time
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self.totals)
+
+class TokenBudget:
+    # spend accounting shared by any number of instances: a request reserves its prompt plus max_tokens before it is sent
+    # and is settled with the usage it actually had, so concurrent requests can never overshoot the limits together
+    # prices are USD per 1K prompt and completion tokens, for the models in Lloom.token_limits
+    prices: Dict[str, Tuple[float, float]] = {
+        "gpt-3.5-turbo-0613": (0.0015, 0.002),
+        "gpt-3.5-turbo-16k-0613": (0.003, 0.004),
+        "gpt-4-0314": (0.03, 0.06),
+        "gpt-4-32k-0314": (0.06, 0.12),
+        "gpt-4-0613": (0.03, 0.06),
+        "gpt-4-32k-0613": (0.06, 0.12),
+        "gpt-3.5-turbo": (0.0015, 0.002),
+        "gpt-3.5-turbo-0301": (0.0015, 0.002),
+    }
+
+    def __init__(self, token_limit: Optional[int] = None, cost_limit: Optional[float] = None, wait: bool = False, timeout: Optional[float] = None, prices: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.token_limit = token_limit
+        self.cost_limit = cost_limit
+        # with wait=True a request that only doesn't fit because of the reservations of others waits for them to settle
+        self.wait = wait
+        self.timeout = timeout
+        if prices is not None:
+            self.prices = {**self.prices, **prices}
+        self._lock = threading.Lock()
+        self._models: Dict[str, List[float]] = {}
+        # the totals are plain numbers only written under the lock, reading them never takes it
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.reserved_tokens = 0
+        self.reserved_cost = 0.0
+        self.rejected = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def price(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = self.prices.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    def _fits(self, tokens: int, cost: float, reserved_tokens: int, reserved_cost: float) -> bool:
+        return (self.token_limit is None or self.total_tokens + reserved_tokens + tokens <= self.token_limit) and (self.cost_limit is None or self.cost + reserved_cost + cost <= self.cost_limit)
+
+    def acquire(self, model: str, prompt_tokens: int, max_tokens: int) -> float:
+        # returns 0 once the request is reserved, otherwise how long to wait before asking again
+        tokens = prompt_tokens + max_tokens
+        cost = self.price(model, prompt_tokens, max_tokens)
+        with self._lock:
+            if self._fits(tokens, cost, self.reserved_tokens, self.reserved_cost):
+                self.reserved_tokens += tokens
+                self.reserved_cost += cost
+                return 0.0
+            # settling can only free what is reserved now, if the request doesn't fit even without it waiting won't help
+            if self.wait and self._fits(tokens, cost, 0, 0.0):
+                return 0.05
+            self.rejected += 1
+            left = [f"{self.remaining_tokens} tokens"] if self.token_limit is not None else []
+            if self.cost_limit is not None:
+                left.append(f"${self.remaining_cost:.4f}")
+        raise BudgetExceededError(f"The request needs up to {tokens} tokens (${cost:.4f}) but only {' and '.join(left)} of the budget left")
+
+    def release(self, model: str, prompt_tokens: int, max_tokens: int, used_prompt_tokens: int = 0, used_completion_tokens: int = 0):
+        reserved_cost = self.price(model, prompt_tokens, max_tokens)
+        cost = self.price(model, used_prompt_tokens, used_completion_tokens)
+        with self._lock:
+            self.reserved_tokens -= prompt_tokens + max_tokens
+            self.reserved_cost -= reserved_cost
+            self.prompt_tokens += used_prompt_tokens
+            self.completion_tokens += used_completion_tokens
+            self.cost += cost
+            usage = self._models.setdefault(model, [0, 0, 0.0])
+            usage[0] += used_prompt_tokens
+            usage[1] += used_completion_tokens
+            usage[2] += cost
+
+    @property
+    def remaining_tokens(self) -> Optional[int]:
+        return None if self.token_limit is None else self.token_limit - self.total_tokens - self.reserved_tokens
+
+    @property
+    def remaining_cost(self) -> Optional[float]:
+        return None if self.cost_limit is None else self.cost_limit - self.cost - self.reserved_cost
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cost": self.cost,
+                "reserved_tokens": self.reserved_tokens,
+                "reserved_cost": self.reserved_cost,
+                "rejected": self.rejected,
+                "models": {model: {"prompt_tokens": usage[0], "completion_tokens": usage[1], "cost": usage[2]} for model, usage in self._models.items()},
+            }
+
+_score_pattern = re.compile(r"Score:\s*(\d+(?:\.\d+)?)")
+
+def extract_score(answer: str) -> Optional[float]:
+    # the "Score: <number>" line the rerank prompt in examples/summarization.py asks for
+    match = _score_pattern.search(answer)
+    return float(match.group(1)) if match else None
+
+class _BestAnswers:
+    # the top_k scored answers so far, ties go to the earlier chunk
+    def __init__(self, score: Callable[[str], Optional[float]], top_k: int, threshold: Optional[float]):
+        self.score = score
+        self.top_k = top_k
+        self.threshold = threshold
+        self.hits = 0
+        self._heap: List[Tuple[float, int, str]] = []
+
+    def add(self, index: int, answer: str):
+        score = self.score(answer)
+        if score is None:
+            return
+        if self.threshold is not None and score >= self.threshold:
+            self.hits += 1
+        entry = (score, -index, answer)
+        if len(self._heap) < self.top_k:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    @property
+    def done(self) -> bool:
+        return self.threshold is not None and self.hits >= self.top_k
+
+    def result(self) -> List[Tuple[float, str]]:
+        return [(score, answer) for score, _, answer in sorted(self._heap, reverse=True)]
 
 class LloomConfig(BaseModel):
     api_key: str
+    api_base: str = "https://api.openai.com/"
     model: str = "gpt-3.5-turbo"
     temperature: float = Field(0.9, ge=0, le=1)
     max_tokens: int = Field(2000, gt=0)
@@ -16,6 +1810,12 @@ class LloomConfig(BaseModel):
     presence_penalty: float = Field(0, ge=0, le=1)
     system_message: str = ""
     logging: bool = True
+    connect_timeout: float = Field(10, gt=0)
+    read_timeout: float = Field(600, gt=0)
+    pool_size: int = Field(10, gt=0)
+    max_concurrency: int = Field(100, gt=0)
+    max_retries: int = Field(5, ge=0)
+    warmup: bool = False
 
 class AzureLloomConfig(LloomConfig):
     api_base: str
@@ -35,8 +1835,24 @@ class Lloom:
         "gpt-3.5-turbo-0301": 4096,
     }
 
-    def __init__(self, config: LloomConfig):
+    api_name: str = "OpenAI"
+
+    def __init__(self, config: LloomConfig, transport: Optional[HTTPTransport] = None, async_transport: Optional[AsyncHTTPTransport] = None, cache: Optional[ResponseCache] = None, retry_policy: Optional[RetryPolicy] = None, rate_limiter: Optional[RateLimiter] = None, context_policy: Optional[ContextPolicy] = None, on_request: Optional[Callable[[RequestMetrics], None]] = None, single_flight: Optional[SingleFlight] = None, history: Optional[PersistentHistory] = None, budget: Optional[TokenBudget] = None, similar_cache: Optional[SimilarPromptCache] = None):
         self.config = config
+        self.on_request = on_request
+        self.single_flight = single_flight
+        self.budget = budget
+        self.context_policy = context_policy or TrimOldestPolicy()
+        # pinned messages by id, holding the message keeps its id from being reused by a later one
+        self._pinned: Dict[int, Message] = {}
+        self.transport = transport or get_transport(config.pool_size)
+        self.async_transport = async_transport or get_async_transport(config.max_concurrency)
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=config.max_retries)
+        self.rate_limiter = rate_limiter or get_rate_limiter(config.api_key, config.max_concurrency)
+        self.cache = cache
+        self.similar_cache = similar_cache
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.logger = logging.getLogger(__name__)
 
         if not self.logger.handlers:
@@ -46,18 +1862,40 @@ class Lloom:
             self.logger.addHandler(handler)
 
         self.api_key = config.api_key
+        self.api_base = config.api_base
         self.model = config.model
         self.temperature = config.temperature
         self.max_tokens = config.max_tokens
         self.top_p = config.top_p
         self.frequency_penalty = config.frequency_penalty
         self.presence_penalty = config.presence_penalty
-        self.system_message: Dict[str, str] = {"role": "system", "content": config.system_message} if config.system_message else None
-        self.messages: List[Dict[str, str]] = [self.system_message] if config.system_message else []
+        self.system_message: Optional[Message] = Message(Role.SYSTEM, config.system_message) if config.system_message else None
+        # a stored session that already has turns is picked up as is, a new one starts from the system message
+        self.history: Union[ConversationHistory, PersistentHistory] = history if history is not None else ConversationHistory()
+        if not len(self.history) and config.system_message:
+            self.messages = [self.system_message]
         if config.logging:
             self.logger.setLevel(logging.INFO)
         else:
             self.logger.setLevel(logging.WARNING)
+        if config.warmup:
+            self.warmup()
+
+    def warmup(self) -> "Lloom":
+        # loads the tokenizer (BPE ranks and regex) and the HTTP client now rather than inside the first request
+        self._get_text_encoding().encode("warmup")
+        self.transport.session
+        return self
+
+    async def aclose(self):
+        # closes this loop's aiohttp session of the async transport, asyncio.run() also does it when the loop shuts down
+        await self.async_transport.close()
+
+    async def __aenter__(self) -> "Lloom":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
 
     def update_config(self, **kwargs):
         current_config_dict = self.config.dict()
@@ -65,61 +1903,155 @@ class Lloom:
             if k in current_config_dict:
                 current_config_dict[k] = v
             else:
-                self.logger.warning(f"Invalid field {k} when trying to update the config, skipping")
+                self.logger.warning("Invalid field %s when trying to update the config, skipping", k)
         try:
-            if isinstance(self.config, LloomConfig):
-                new_config = LloomConfig(**current_config_dict)
-            elif isinstance(self.config, AzureLloomConfig):
+            # AzureLloomConfig is a LloomConfig too, so it has to be checked first
+            if isinstance(self.config, AzureLloomConfig):
                 new_config = AzureLloomConfig(**current_config_dict)
+            elif isinstance(self.config, LloomConfig):
+                new_config = LloomConfig(**current_config_dict)
             else: 
                 self.logger.error("Unexpected config type, values were not updated")
                 return
             self.config = new_config
+            if new_config.api_key != self.api_key:
+                self.rate_limiter = get_rate_limiter(new_config.api_key, new_config.max_concurrency)
+            self.retry_policy.max_retries = new_config.max_retries
             self.api_key = new_config.api_key
-            self.model = new_config.model
+            self.api_base = new_config.api_base
             self.temperature = new_config.temperature
             self.max_tokens = new_config.max_tokens
             self.top_p = new_config.top_p
             self.frequency_penalty = new_config.frequency_penalty
             self.presence_penalty = new_config.presence_penalty
-            self.system_message: Dict[str, str] = {"role": "system", "content": new_config.system_message} if new_config.system_message else None
+            self.system_message = Message(Role.SYSTEM, new_config.system_message) if new_config.system_message else None
+            # the token counts only depend on the model, a stored session is rewritten only when it changes
+            if new_config.model != self.model:
+                self.model = new_config.model
+                self._recount_history()
             if new_config.logging:
                 self.logger.setLevel(logging.INFO)
         except ValidationError as e:
-            self.logger.error(f"Invalid value received when trying to update the config, the fields were not updated. {e}")
+            self.logger.error("Invalid value received when trying to update the config, the fields were not updated. %s", e)
+
+    @property
+    def messages(self) -> MessageList:
+        # plain dicts for callers, the history itself holds Message objects and edits made through the view are written to it
+        return MessageList(self)
+
+    @messages.setter
+    def messages(self, messages: List[Union[Dict[str, str], Message]]):
+        # per-message costs are cached on the messages, so a turn only tokenizes the new message
+        messages = [self._make_message(message["role"], message["content"], message.get("name")) for message in messages]
+        if isinstance(self.history, PersistentHistory):
+            self.history.reset(messages)
+        else:
+            self.history = ConversationHistory(messages)
+        # the new history is made of new messages, pins on the old ones no longer apply
+        self._pinned = {}
+
+    def _make_message(self, role: Union[Role, str], content: str, name: Optional[str] = None) -> Message:
+        message = Message(role, content, name)
+        message.tokens = self._count_message_tokens(message)
+        return message
+
+    def _to_message(self, message: Union[Dict[str, str], Message]) -> Message:
+        # messages are never edited once created, so one that is already counted is used as it is
+        if isinstance(message, Message):
+            return message
+        return self._make_message(message["role"], message["content"], message.get("name"))
+
+    def _replace_message(self, index: int, message: Message) -> Message:
+        old = self.history[index]
+        self.history.replace(index, message)
+        if self._pinned.pop(id(old), None) is not None:
+            self.pin_message(index)
+        if index == 0 and old.role is Role.SYSTEM and message.role is Role.SYSTEM:
+            self.system_message = message
+        return message
+
+    def _replace_history(self, messages: List[Message]):
+        # unlike assigning messages, this keeps the message objects and with them their pins
+        pinned = [i for i, message in enumerate(messages) if id(message) in self._pinned]
+        if isinstance(self.history, PersistentHistory):
+            self.history.reset(messages)
+        else:
+            self.history = ConversationHistory(messages)
+        self._pinned = {}
+        for i in pinned:
+            self.pin_message(i)
 
     def set_system_message(self, content: str):
-        self.system_message["content"] = content
-        if self.messages and self.messages[0]["role"] == "system":
-            self.messages[0] = self.system_message
+        # a new message rather than an edit in place, the old one may be shared with forks
+        self.system_message = self._make_message(Role.SYSTEM, content)
+        if len(self.history) and self.history[0].role is Role.SYSTEM:
+            self._replace_message(0, self.system_message)
         else:
-            self.messages.insert(0, self.system_message)
-        self.logger.info(f"Added system message: {content}")
+            self.history.prepend(self.system_message)
+        self.logger.info("Added system message: %s", content)
+
+    def add_user_message(self, content: str, pinned: bool = False):
+        self._append_message(self._make_message(Role.USER, content), pinned)
+        self.logger.info("Added user message: %s", content)
 
-    def add_user_message(self, content: str):
-        self.messages.append({"role": "user", "content": content})
-        self.logger.info(f"Added user message: {content}")
+    def add_assistant_message(self, content: str, pinned: bool = False):
+        self._append_message(self._make_message(Role.ASSISTANT, content), pinned)
+        self.logger.info("Added assistant message: %s", content)
 
-    def add_assistant_message(self, content: str):
-        self.messages.append({"role": "assistant", "content": content})
-        self.logger.info(f"Added assistant message: {content}")
+    def pin_message(self, index: int):
+        message = self.history.pin(index)
+        self._pinned[id(message)] = message
 
-    def get_conversation_history(self) -> List[Dict[str, str]]:
+    def unpin_message(self, index: int):
+        self._pinned.pop(id(self.history.unpin(index)), None)
+
+    def get_conversation_history(self) -> MessageList:
         return self.messages
     
-    def clear_history(self, clear_system_message: bool = False) -> List[Dict[str, str]]:
+    def clear_history(self, clear_system_message: bool = False) -> MessageList:
         if not clear_system_message and self.system_message:
             self.messages = [self.system_message]
         else:
             self.messages = []
         return self.messages
 
-    def get_token_count(self, messages: List[Dict[str, str]], model: str) -> int:
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            self.logger.warning(f"Tried counting tokens for {model} but failed. Had to switch to cl100k_base encoding.")
-            encoding = tiktoken.get_encoding("cl100k_base")
+    def fork(self) -> "Lloom":
+        # the fork shares config, transports, caches and the history so far, only the turns added afterwards are its own
+        child = copy.copy(self)
+        child.history = self.history.fork()
+        child._pinned = dict(self._pinned)
+        return child
+
+    def _append_message(self, message: Message, pinned: bool = False):
+        self.history.append(message)
+        if pinned:
+            self._pinned[id(message)] = message
+
+    def _recount_history(self):
+        # recounting builds new messages instead of editing the old ones, forks made under the previous model still share those
+        messages = self.history.to_list()
+        pinned = [i for i, message in enumerate(messages) if id(message) in self._pinned]
+        self.messages = messages
+        for i in pinned:
+            self.pin_message(i)
+
+    def get_history_token_count(self) -> int:
+        return self.history.total_tokens + 3 if len(self.history) else 0
+
+    def _get_encoding(self, model: str) -> tiktoken.Encoding:
+        encoding = _encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.logger.warning("Tried counting tokens for %s but failed. Had to switch to cl100k_base encoding.", model)
+                encoding = tiktoken.get_encoding("cl100k_base")
+            _encodings[model] = encoding
+        return encoding
+
+    def _get_token_params(self, model: str) -> Optional[Tuple[tiktoken.Encoding, int, int]]:
+        if model in _token_params:
+            return _token_params[model]
         if model in {
             "gpt-3.5-turbo-0613",
             "gpt-3.5-turbo-16k-0613",
@@ -128,55 +2060,161 @@ class Lloom:
             "gpt-4-0613",
             "gpt-4-32k-0613",
             }:
-            tokens_per_message = 3
-            tokens_per_name = 1
+            params = (self._get_encoding(model), 3, 1)
         elif model == "gpt-3.5-turbo-0301":
-            tokens_per_message = 4
-            tokens_per_name = -1
+            params = (self._get_encoding(model), 4, -1)
         elif "gpt-3.5-turbo" in model:
             self.logger.warning("gpt-3.5-turbo may update over time. Returning number of tokens assuming gpt-3.5-turbo-0613.")
-            return self.get_token_count(self.messages, model="gpt-3.5-turbo-0613")
+            params = self._get_token_params("gpt-3.5-turbo-0613")
         elif "gpt-4" in model:
             self.logger.warning("gpt-4 may update over time. Returning number of tokens tokens assuming gpt-4-0613.")
-            return self.get_token_count(self.messages, model="gpt-4-0613")
+            params = self._get_token_params("gpt-4-0613")
         else:
             self.logger.warning(
                 f'''The function of counting tokens is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens. 
                 Your program may fail if you exceed the token limit.'''
             )
+            params = None
+        _token_params[model] = params
+        return params
+
+    def _count_message_tokens(self, message: Dict[str, str], model: Optional[str] = None) -> int:
+        params = self._get_token_params(model or self.model)
+        if params is None:
+            return 0
+        encoding, tokens_per_message, tokens_per_name = params
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            if isinstance(value, RenderedPrompt) and value.encoding == encoding.name:
+                num_tokens += value.tokens
+            else:
+                num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += tokens_per_name
+        return num_tokens
+
+    def get_token_count(self, messages: List[Dict[str, str]], model: str) -> int:
+        if self._get_token_params(model) is None:
             return 0
         num_tokens = 0
         for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":
-                    num_tokens += tokens_per_name
+            num_tokens += self._count_message_tokens(message, model)
         num_tokens += 3
         return num_tokens
     
-    def validate_token_count(self, prompt_tokens: int) -> bool:
-        total_tokens = prompt_tokens + self.max_tokens
-        if prompt_tokens > self.token_limits[self.model]:
-            self.logger.warning("Token limit is exceeded in the prompt already, deleting the first non-system message")
-            if self.messages[0]["role"] == "system":
-                del self.messages[1]
-            else:
-                del self.messages[0]
-            prompt_tokens = self.get_token_count(self.messages, self.model)
-            return self.validate_token_count(prompt_tokens)
-        elif total_tokens > self.token_limits[self.model]:
-            self.max_tokens = self.token_limits[self.model] - prompt_tokens
-            self.logger.warning(f"Token limit is exceeded, decreased max tokens to {self.max_tokens}")
-            return self.validate_token_count(prompt_tokens)
-        elif not self.messages:
+    def _count_user_messages(self, prompts: List[str]) -> List[int]:
+        params = self._get_token_params(self.model)
+        if params is None:
+            return [0] * len(prompts)
+        encoding, tokens_per_message, _ = params
+        role_tokens = tokens_per_message + len(encoding.encode("user"))
+        # rendered templates already know their count, only the rest goes through the tokenizer
+        counts = [prompt.tokens if isinstance(prompt, RenderedPrompt) and prompt.encoding == encoding.name else None for prompt in prompts]
+        encoded = iter(encoding.encode_batch([prompt for prompt, count in zip(prompts, counts) if count is None]))
+        return [role_tokens + (len(next(encoded)) if count is None else count) for count in counts]
+
+    def count_tokens_many(self, items: Iterable[Union[str, List[Dict[str, str]]]], model: Optional[str] = None, num_threads: int = 8, processes: Optional[int] = None, process_threshold: int = 20_000_000) -> array:
+        # raw texts are counted as is, message lists the same way get_token_count does
+        model = model or self.model
+        params = self._get_token_params(model)
+        encoding = params[0] if params else self._get_encoding(model)
+        texts: List[str] = []
+        owners = array("I")
+        counts = array("I")
+        for index, item in enumerate(items):
+            if isinstance(item, str):
+                texts.append(item)
+                owners.append(index)
+                counts.append(0)
+                continue
+            if params is None:
+                counts.append(0)
+                continue
+            _, tokens_per_message, tokens_per_name = params
+            overhead = 3
+            for message in item:
+                overhead += tokens_per_message
+                for key, value in message.items():
+                    texts.append(value)
+                    owners.append(index)
+                    if key == "name":
+                        overhead += tokens_per_name
+            counts.append(overhead)
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes > 1 and sum(map(len, texts)) >= process_threshold:
+            # past a few tens of megabytes the python side of encoding dominates, so the work is spread over processes
+            size = -(-len(texts) // (processes * 4))
+            chunks = [texts[start:start + size] for start in range(0, len(texts), size)]
+            text_counts = array("I")
+            with futures.ProcessPoolExecutor(processes) as executor:
+                for part in executor.map(_count_texts_worker, [encoding.name] * len(chunks), chunks):
+                    text_counts.extend(part)
+        else:
+            text_counts = _count_texts(encoding, texts, num_threads)
+        for owner, count in zip(owners, text_counts):
+            counts[owner] += count
+        return counts
+
+    def _pinned_flags(self, messages: Union[List[Dict[str, str]], ConversationHistory, PersistentHistory]) -> List[bool]:
+        if isinstance(messages, list):
+            system = Role.SYSTEM
+            pinned = [(message.role is system if isinstance(message, Message) else message["role"] == "system") or id(message) in self._pinned for message in messages]
+        else:
+            pinned = messages.pinned_flags(self._pinned)
+        # the last message is the one being answered, so it is never evicted
+        pinned[-1] = True
+        return pinned
+
+    def _fit_context(self, messages: Union[List[Dict[str, str]], ConversationHistory, PersistentHistory], message_tokens: List[int], metrics: Optional[RequestMetrics] = None) -> Optional[Tuple[List[Dict[str, str]], int]]:
+        # given a history, the policy only looks at the token counts and the messages it needs, and only the kept ones are loaded
+        token_limit = self.token_limits[self.model]
+        pinned = self._pinned_flags(messages)
+        fitted = self.context_policy.fit(messages, message_tokens, pinned, token_limit, self.max_tokens)
+        if fitted is not None and metrics is not None:
+            # every reply is primed with <|start|>assistant<|message|>
+            metrics.prompt_tokens = sum(message_tokens[i] for i in fitted[0]) + 3
+        if fitted is None:
+            self.logger.error("The pinned messages and the prompt don't fit into the %d token limit of %s. Probably you should decrease the length of your message", token_limit, self.model)
+            return None
+        kept, max_tokens = fitted
+        if len(kept) < len(messages):
+            self.logger.warning("Token limit is exceeded, left %d messages out of the context for this request", len(messages) - len(kept))
+        if not isinstance(messages, list):
+            messages = messages.select(kept)
+        elif len(kept) < len(messages):
+            messages = [messages[i] for i in kept]
+        if max_tokens < self.max_tokens:
+            self.logger.warning("Token limit is exceeded, decreased max tokens to %d for this request", max_tokens)
+        return messages, max_tokens
+
+    def validate_token_count(self, prompt_tokens: Optional[int] = None) -> bool:
+        # generate() applies self.context_policy per request instead, this trims the history itself and lowers self.max_tokens
+        # prompt_tokens is ignored and only kept for existing callers, the cached per-message counts are used instead
+        if not len(self.history):
             self.logger.error("It turns out that after clearing the context, there are no messages at all. Probably you should decrease the length of your message")
             return False
-        else:
-            return True
+        messages = self.history.to_list()
+        pinned = self._pinned_flags(messages)
+        token_limit = self.token_limits[self.model]
+        fitted = TrimOldestPolicy().fit(messages, self.history.token_list(), pinned, token_limit, self.max_tokens)
+        if fitted is None:
+            self.logger.error("It turns out that after clearing the context, the prompt still doesn't fit. Probably you should decrease the length of your message")
+            return False
+        kept, max_tokens = fitted
+        if len(kept) < len(messages):
+            self.logger.warning("Token limit is exceeded in the prompt already, deleted %d of the first non-system messages", len(messages) - len(kept))
+            removed = set(range(len(messages))) - set(kept)
+            for i in removed:
+                self._pinned.pop(id(messages[i]), None)
+            self.history.retain(kept)
+        if max_tokens < self.max_tokens:
+            self.max_tokens = max_tokens
+            self.logger.warning("Token limit is exceeded, decreased max tokens to %d", self.max_tokens)
+        return True
         
-    def get_completion(self, messages: List[Dict[str, str]]) -> Dict:
-        url = "https://api.openai.com/v1/chat/completions"
+    def _build_request(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> Tuple[str, Dict[str, str], Dict]:
+        url = f"{self.api_base}v1/chat/completions"
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
@@ -184,74 +2222,787 @@ class Lloom:
         data = {
             "model": self.model,
             "messages": messages,
-            "max_tokens": self.max_tokens,
+            "max_tokens": max_tokens or self.max_tokens,
             "temperature": self.temperature,
             "frequency_penalty": self.frequency_penalty,
             "presence_penalty": self.presence_penalty,
             "top_p": self.top_p,
             "stop": None
         }
+        return url, headers, data
+
+    def _similar_key(self, url: str, data: Dict) -> Optional[Tuple[str, array]]:
+        # only the last user message is matched approximately, the rest of the request has to be the same apart from
+        # max_tokens, which context fitting changes with the length of the prompt
+        messages = data["messages"]
+        if not messages or messages[-1]["role"] != "user":
+            return None
+        context = {key: value for key, value in data.items() if key != "max_tokens"}
+        context["messages"] = messages[:-1]
+        scope = hashlib.sha256(f"{url}\n{_encode_request(context)}".encode()).hexdigest()
+        return scope, self.similar_cache.signature(messages[-1]["content"], self._get_text_encoding())
+
+    def _cache_lookup(self, url: str, data: Dict) -> Tuple[Optional[str], Optional[Tuple[str, array]], Optional[Dict]]:
+        if self.cache is None and self.similar_cache is None:
+            return None, None, None
+        key = similar = completion = None
+        if self.cache is not None:
+            key = self.cache.make_key(url, data)
+            completion = self.cache.get(key)
+        if completion is None and self.similar_cache is not None:
+            similar = self._similar_key(url, data)
+            if similar is not None:
+                completion = self.similar_cache.get(*similar)
+        if completion is None:
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+            self.logger.info("Returning a cached completion")
+        return key, similar, completion
+
+    def _cache_store(self, key: Optional[str], similar: Optional[Tuple[str, array]], completion: Dict):
+        # only successful completions are cached, errors should be retried
+        if "choices" not in completion:
+            return
+        if key is not None:
+            self.cache.set(key, completion)
+        if similar is not None:
+            self.similar_cache.set(*similar, completion)
+
+    def _retry_delay(self, attempt: int, status_code: Optional[int] = None, headers: Optional[Dict[str, str]] = None) -> Optional[float]:
+        if attempt >= self.retry_policy.max_retries:
+            return None
+        if status_code is not None and status_code not in self.retry_policy.retry_statuses:
+            return None
+        delay = self.retry_policy.get_delay(attempt, headers)
+        if status_code == 429:
+            # back off every instance sharing the key, not only this one
+            self.rate_limiter.pause(delay)
+        reason = f"status {status_code}" if status_code is not None else "a connection error"
+        self.logger.warning("%s returned %s, retrying in %.2f seconds (attempt %d of %d)", self.api_name, reason, delay, attempt + 1, self.retry_policy.max_retries)
+        return delay
+
+    def _api_error(self, status_code: int, body: str) -> LloomAPIError:
+        self.logger.error("%s API returned status %s: %s", self.api_name, status_code, body)
+        return LloomAPIError(f"{self.api_name} API returned status {status_code}: {body}", status_code, body)
+
+    def _record_metrics(self, metrics: RequestMetrics, completion: Optional[Dict] = None):
+        if completion is not None and completion.get("usage"):
+            metrics.prompt_tokens = completion["usage"].get("prompt_tokens", metrics.prompt_tokens)
+            metrics.completion_tokens = completion["usage"].get("completion_tokens", metrics.completion_tokens)
+        metrics.total_time = time.perf_counter() - metrics._start
+        if metrics._reserved is not None:
+            # only answered requests are paid for, a stream that broke off still pays for what it got. A request the caller
+            # gave up on after it went out may still be billed, so it keeps its whole reservation
+            if metrics.status_code is not None and metrics.status_code < 400:
+                used = (metrics.prompt_tokens or 0, metrics.completion_tokens or 0)
+            elif metrics._sent:
+                used = metrics._reserved
+            else:
+                used = (0, 0)
+            self.budget.release(metrics.model, *metrics._reserved, *used)
+            metrics._reserved = None
+        self.logger.info("%s request finished: %s", self.api_name, metrics)
+        if self.on_request is not None:
+            try:
+                self.on_request(metrics)
+            except Exception:
+                self.logger.exception("The on_request callback failed")
+
+    def _budget_delay(self, data: Dict, metrics: RequestMetrics, waited: float) -> float:
+        if metrics.prompt_tokens is None:
+            # counted while fitting the context for generate(), a direct get_completion() call is counted here
+            metrics.prompt_tokens = self.get_token_count(data["messages"], self.model) or _estimate_request_tokens(data) - data["max_tokens"]
+        if self.budget.timeout is not None and waited >= self.budget.timeout:
+            raise BudgetExceededError(f"Waited {waited:.2f} seconds for the token budget to free up")
+        delay = self.budget.acquire(self.model, metrics.prompt_tokens, data["max_tokens"])
+        if not delay:
+            metrics._reserved = (metrics.prompt_tokens, data["max_tokens"])
+        return delay
+
+    def _reserve_budget(self, data: Dict, metrics: RequestMetrics):
+        if self.budget is None:
+            return
+        waited = 0.0
+        delay = self._budget_delay(data, metrics, waited)
+        while delay > 0:
+            time.sleep(delay)
+            waited += delay
+            metrics.queue_wait += delay
+            delay = self._budget_delay(data, metrics, waited)
+
+    async def _areserve_budget(self, data: Dict, metrics: RequestMetrics):
+        if self.budget is None:
+            return
+        waited = 0.0
+        delay = self._budget_delay(data, metrics, waited)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+            metrics.queue_wait += delay
+            delay = self._budget_delay(data, metrics, waited)
+
+    def _send(self, url: str, headers: Dict[str, str], data: Dict, stream: bool = False, metrics: Optional[RequestMetrics] = None) -> requests.Response:
+        metrics = metrics or RequestMetrics(self.model, stream)
+        body = _encode_request(data)
+        tokens = _estimate_request_tokens(data)
+        attempt = 0
+        while True:
+            delay = self.rate_limiter.acquire(tokens)
+            while delay > 0:
+                time.sleep(delay)
+                metrics.queue_wait += delay
+                delay = self.rate_limiter.acquire(tokens)
+            sent = time.perf_counter()
+            try:
+                response = self.transport.post(url, headers, body, timeout=(self.config.connect_timeout, self.config.read_timeout), stream=stream)
+            except self.transport.retryable_errors as e:
+                self.rate_limiter.release()
+                delay = self._retry_delay(attempt)
+                if delay is None:
+                    self.logger.error("An error occurred while trying to get a response from %s: %s", self.api_name, e)
+                    raise LloomAPIError(f"Could not get a response from {self.api_name}: {e}") from e
+            except Exception as e:
+                self.rate_limiter.release()
+                self.logger.error("An error occurred while trying to get a response from %s: %s", self.api_name, e)
+                raise
+            else:
+                metrics.status_code = response.status_code
+                self.rate_limiter.release(response.status_code, response.headers)
+                if response.status_code < 400:
+                    return response
+                delay = self._retry_delay(attempt, response.status_code, response.headers)
+                if delay is None:
+                    with response:
+                        raise self._api_error(response.status_code, response.text)
+                response.close()
+            finally:
+                metrics.network_time += time.perf_counter() - sent
+            time.sleep(delay)
+            attempt += 1
+            metrics.retries = attempt
+
+    async def _asend(self, url: str, headers: Dict[str, str], data: Dict, metrics: Optional[RequestMetrics] = None) -> AsyncResponse:
+        metrics = metrics or RequestMetrics(self.model)
+        body = _encode_request(data)
+        tokens = _estimate_request_tokens(data)
+        attempt = 0
+        while True:
+            delay = self.rate_limiter.acquire(tokens)
+            while delay > 0:
+                await asyncio.sleep(delay)
+                metrics.queue_wait += delay
+                delay = self.rate_limiter.acquire(tokens)
+            sent = time.perf_counter()
+            queue_wait = 0.0
+            metrics._sent = True
+            try:
+                response = await self.async_transport.post(url, headers, body, timeout=(self.config.connect_timeout, self.config.read_timeout))
+            except self.async_transport.retryable_errors as e:
+                metrics._sent = False
+                self.rate_limiter.release()
+                delay = self._retry_delay(attempt)
+                if delay is None:
+                    self.logger.error("An error occurred while trying to get a response from %s: %s", self.api_name, e)
+                    raise LloomAPIError(f"Could not get a response from {self.api_name}: {e}") from e
+            except BaseException as e:
+                self.rate_limiter.release()
+                if isinstance(e, Exception):
+                    metrics._sent = False
+                    self.logger.error("An error occurred while trying to get a response from %s: %s", self.api_name, e)
+                raise
+            else:
+                metrics._sent = False
+                # the wait for a transport slot is queueing, not network time
+                queue_wait = response.queue_wait
+                metrics.queue_wait += queue_wait
+                metrics.status_code = response.status_code
+                self.rate_limiter.release(response.status_code, response.headers)
+                if response.status_code < 400:
+                    return response
+                delay = self._retry_delay(attempt, response.status_code, response.headers)
+                if delay is None:
+                    raise self._api_error(response.status_code, response.text)
+            finally:
+                metrics.network_time += time.perf_counter() - sent - queue_wait
+            await asyncio.sleep(delay)
+            attempt += 1
+            metrics.retries = attempt
+
+    def get_completion(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None, metrics: Optional[RequestMetrics] = None) -> Dict:
+        metrics = metrics or RequestMetrics(self.model)
+        completion = None
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(data))
-        except Exception as e: 
-            self.logger.error(f"An error occurred while trying to get a response from OpenAI: {e}")
-        return(response.json())
+            url, headers, data = self._build_request(messages, max_tokens)
+            key, similar, completion = self._cache_lookup(url, data)
+            if completion is not None:
+                metrics.cache_hit = True
+                return completion
+            def send():
+                # only the request that actually goes out reserves budget, cache hits and coalesced callers spend nothing
+                self._reserve_budget(data, metrics)
+                return self._send(url, headers, data, metrics=metrics).json()
+            if self.single_flight is None:
+                completion = send()
+            else:
+                flight_key = key or ResponseCache.make_key(url, data)
+                completion, metrics.coalesced = self.single_flight.do(flight_key, send)
+            if not metrics.coalesced:
+                self._cache_store(key, similar, completion)
+            return completion
+        except Exception as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            self._record_metrics(metrics, completion)
 
-    def generate(self, prompt: str) -> str:
-        proceed_to_generate = True
+    async def aget_completion(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None, metrics: Optional[RequestMetrics] = None) -> Dict:
+        metrics = metrics or RequestMetrics(self.model)
+        completion = None
+        settled_by_send = False
+        try:
+            url, headers, data = self._build_request(messages, max_tokens)
+            key, similar, completion = self._cache_lookup(url, data)
+            if completion is not None:
+                metrics.cache_hit = True
+                return completion
+            async def send():
+                # the request settles its own budget and cache entry, a shared request keeps going when its leader is
+                # cancelled and the followers still get the answer
+                result = None
+                try:
+                    await self._areserve_budget(data, metrics)
+                    result = (await self._asend(url, headers, data, metrics)).json()
+                    self._cache_store(key, similar, result)
+                    return result
+                except Exception as e:
+                    metrics.error = str(e)
+                    raise
+                finally:
+                    self._record_metrics(metrics, result)
+            def start():
+                nonlocal settled_by_send
+                settled_by_send = True
+                return send()
+            if self.single_flight is None:
+                completion = await start()
+            else:
+                flight_key = key or ResponseCache.make_key(url, data)
+                completion, metrics.coalesced = await self.single_flight.ado(flight_key, start)
+            return completion
+        except Exception as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            if not settled_by_send:
+                self._record_metrics(metrics, completion)
+
+    def _stream_delta(self, metrics: RequestMetrics):
+        if metrics.first_token_time is None:
+            metrics.first_token_time = time.perf_counter() - metrics._start
+            metrics.completion_tokens = 0
+        # there is no usage in streamed responses, but every chunk carries a single token
+        metrics.completion_tokens += 1
+
+    def get_completion_stream(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None, metrics: Optional[RequestMetrics] = None) -> Iterator[str]:
+        metrics = metrics or RequestMetrics(self.model)
+        metrics.stream = True
+        try:
+            url, headers, data = self._build_request(messages, max_tokens)
+            data["stream"] = True
+            self._reserve_budget(data, metrics)
+            response = self._send(url, headers, data, stream=True, metrics=metrics)
+            # closing the response drops the connection, which is what stops the generation when the caller stops early
+            with response:
+                for line in response.iter_lines():
+                    done, delta = _parse_stream_line(line)
+                    if done:
+                        break
+                    if delta:
+                        self._stream_delta(metrics)
+                        yield delta
+        except Exception as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            self._record_metrics(metrics)
+
+    async def aget_completion_stream(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None, metrics: Optional[RequestMetrics] = None) -> AsyncIterator[str]:
+        metrics = metrics or RequestMetrics(self.model)
+        metrics.stream = True
+        stream = None
+        try:
+            url, headers, data = self._build_request(messages, max_tokens)
+            data["stream"] = True
+            await self._areserve_budget(data, metrics)
+            stream = self._astream(url, headers, data, metrics)
+            async for delta in stream:
+                self._stream_delta(metrics)
+                yield delta
+        except Exception as e:
+            metrics.error = str(e)
+            raise
+        finally:
+            if stream is not None:
+                await stream.aclose()
+            self._record_metrics(metrics)
+
+    async def _astream(self, url: str, headers: Dict[str, str], data: Dict, metrics: RequestMetrics) -> AsyncIterator[str]:
+        body = _encode_request(data)
+        tokens = _estimate_request_tokens(data)
+        attempt = 0
+        while True:
+            delay = self.rate_limiter.acquire(tokens)
+            while delay > 0:
+                await asyncio.sleep(delay)
+                metrics.queue_wait += delay
+                delay = self.rate_limiter.acquire(tokens)
+            released = False
+            sent = time.perf_counter()
+            metrics._sent = True
+            try:
+                async with self.async_transport.stream(url, headers, body, timeout=(self.config.connect_timeout, self.config.read_timeout)) as response:
+                    metrics.network_time += time.perf_counter() - sent - response.queue_wait
+                    metrics.queue_wait += response.queue_wait
+                    metrics._sent = False
+                    metrics.status_code = response.status_code
+                    self.rate_limiter.release(response.status_code, response.headers)
+                    released = True
+                    if response.status_code < 400:
+                        async for line in response.iter_lines():
+                            done, delta = _parse_stream_line(line)
+                            if done:
+                                break
+                            if delta:
+                                yield delta
+                        return
+                    await response.read()
+                    delay = self._retry_delay(attempt, response.status_code, response.headers)
+                    if delay is None:
+                        raise self._api_error(response.status_code, response.text)
+            except self.async_transport.retryable_errors as e:
+                if released:
+                    self.logger.error("An error occurred while streaming a response from %s: %s", self.api_name, e)
+                    raise
+                metrics.network_time += time.perf_counter() - sent
+                metrics._sent = False
+                self.rate_limiter.release()
+                delay = self._retry_delay(attempt)
+                if delay is None:
+                    self.logger.error("An error occurred while trying to get a response from %s: %s", self.api_name, e)
+                    raise LloomAPIError(f"Could not get a response from {self.api_name}: {e}") from e
+            except BaseException as e:
+                if not released:
+                    self.rate_limiter.release()
+                if isinstance(e, Exception):
+                    metrics._sent = False
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            metrics.retries = attempt
+
+    def _prepare_generation(self, prompt: str) -> Optional[Tuple[List[Dict[str, str]], Optional[int], RequestMetrics]]:
+        metrics = RequestMetrics(self.model)
         self.add_user_message(prompt)
         if self.model in self.token_limits:
-            prompt_tokens = self.get_token_count(self.messages, self.model)
-            proceed_to_generate = self.validate_token_count(prompt_tokens)
+            prepared = self._fit_context(self.history, self.history.token_list(), metrics)
         else:
-            self.logger.warning(f"Unknown model: {self.model}, skipping token counting steps")
-        if proceed_to_generate:
+            self.logger.warning("Unknown model: %s, skipping token counting steps", self.model)
+            prepared = (self.history.to_list(), None)
+        metrics.tokenization_time = time.perf_counter() - metrics._start
+        if prepared is None:
+            return None
+        self.logger.info("Generating for the prompt: %s", prompt)
+        self.logger.info("The current history is: %s", prepared[0])
+        return prepared + (metrics,)
+
+    def _parse_completion(self, completion: Dict) -> str:
+        return completion["choices"][0]["message"]['content']
+
+    def _finish_generation(self, completion: Dict) -> str:
+        response = self._parse_completion(completion)
+        self.add_assistant_message(response)
+        return response
+
+    def generate(self, prompt: str) -> str:
+        prepared = self._prepare_generation(prompt)
+        if prepared is not None:
+            completion = None
             try:
-                start_time = time.time()
-                self.logger.info(f"Generating for the prompt: {prompt}")
-                self.logger.info(f"The current history is: {self.messages}")
-                completion = self.get_completion(self.messages)
-                response = completion["choices"][0]["message"]['content']
-                token_usage = completion["usage"]["total_tokens"]
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-                self.logger.info(f"Consumed {token_usage} tokens, completed in {elapsed_time} seconds")
-                self.add_assistant_message(response)
-                return response
+                completion = self.get_completion(*prepared)
+                return self._finish_generation(completion)
+            except LloomError:
+                raise
             except Exception as e:
-                self.logger.error(f'An error occurred: {str(e)}, this is the response from OpenAI API: {completion}')
+                self.logger.error("An error occurred: %s, this is the response from %s API: %s", e, self.api_name, completion)
+                return str(e)
+
+    async def agenerate(self, prompt: str) -> str:
+        prepared = self._prepare_generation(prompt)
+        if prepared is not None:
+            completion = None
+            try:
+                completion = await self.aget_completion(*prepared)
+                return self._finish_generation(completion)
+            except LloomError:
+                raise
+            except Exception as e:
+                self.logger.error("An error occurred: %s, this is the response from %s API: %s", e, self.api_name, completion)
                 return str(e)
             
-class AzureLloom(Lloom):
-    def __init__(self, config: AzureLloomConfig):
-        self.config = config
-        self.logger = logging.getLogger(__name__)
+    def generate_stream(self, prompt: str, stop: Optional[Union[str, List[str]]] = None) -> Iterator[str]:
+        prepared = self._prepare_generation(prompt)
+        if prepared is None:
+            return
+        detector = _StopDetector(stop)
+        parts = []
+        stream = self.get_completion_stream(*prepared)
+        finished = False
+        try:
+            for delta in stream:
+                delta, stopped = detector.feed(delta)
+                parts.append(delta)
+                yield delta
+                if stopped:
+                    self.logger.info("Stop sequence received, closing the stream")
+                    break
+            finished = True
+        except GeneratorExit:
+            finished = True
+            raise
+        except Exception as e:
+            self.logger.error("An error occurred while streaming: %s", e)
+            raise
+        finally:
+            stream.close()
+            if finished:
+                self.add_assistant_message("".join(parts))
 
-        if not self.logger.handlers:
-            handler = logging.StreamHandler()
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
+    async def agenerate_stream(self, prompt: str, stop: Optional[Union[str, List[str]]] = None) -> AsyncIterator[str]:
+        prepared = self._prepare_generation(prompt)
+        if prepared is None:
+            return
+        detector = _StopDetector(stop)
+        parts = []
+        stream = self.aget_completion_stream(*prepared)
+        finished = False
+        try:
+            async for delta in stream:
+                delta, stopped = detector.feed(delta)
+                parts.append(delta)
+                yield delta
+                if stopped:
+                    self.logger.info("Stop sequence received, closing the stream")
+                    break
+            finished = True
+        except GeneratorExit:
+            finished = True
+            raise
+        except Exception as e:
+            self.logger.error("An error occurred while streaming: %s", e)
+            raise
+        finally:
+            await stream.aclose()
+            if finished:
+                self.add_assistant_message("".join(parts))
 
+    def _prepare_batch(self, prompts: List[str]) -> List[Union[Tuple[List[Dict[str, str]], Optional[int], RequestMetrics], Exception]]:
+        history = self.history.to_list()
+        history_tokens = self.history.token_list()
+        count_tokens = self.model in self.token_limits
+        if not count_tokens:
+            self.logger.warning("Unknown model: %s, skipping token counting steps", self.model)
+        start = time.perf_counter()
+        prompt_tokens = self._count_user_messages(prompts) if count_tokens else [0] * len(prompts)
+        # the prompts are encoded in one batch, each request gets its share of that time
+        shared_time = (time.perf_counter() - start) / max(1, len(prompts))
+        batch = []
+        for prompt, tokens in zip(prompts, prompt_tokens):
+            metrics = RequestMetrics(self.model)
+            messages = history + [Message(Role.USER, prompt, tokens=tokens)]
+            fitted = self._fit_context(messages, history_tokens + [tokens], metrics) if count_tokens else (messages, None)
+            metrics.tokenization_time = shared_time + time.perf_counter() - metrics._start
+            if fitted is None:
+                batch.append(TokenLimitError(f"The prompt does not fit into the {self.token_limits[self.model]} token limit of {self.model}"))
+            else:
+                batch.append(fitted + (metrics,))
+        return batch
+
+    def generate_many(self, prompts: List[str], max_concurrency: Optional[int] = None) -> List[Union[str, Exception]]:
+        def run(item):
+            if isinstance(item, Exception):
+                return item
+            # the time spent waiting for a worker thread is queueing too
+            item[2].queue_wait += time.perf_counter() - prepared
+            completion = None
+            try:
+                completion = self.get_completion(*item)
+                return self._parse_completion(completion)
+            except Exception as e:
+                self.logger.error("An error occurred: %s, this is the response from %s API: %s", e, self.api_name, completion)
+                return e
+
+        batch = self._prepare_batch(prompts)
+        prepared = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=max_concurrency or self.config.pool_size) as executor:
+            return list(executor.map(run, batch))
+
+    async def agenerate_many(self, prompts: List[str], max_concurrency: Optional[int] = None) -> List[Union[str, Exception]]:
+        semaphore = asyncio.Semaphore(max_concurrency or self.config.max_concurrency)
+
+        async def run(item):
+            if isinstance(item, Exception):
+                return item
+            completion = None
+            try:
+                waiting = time.perf_counter()
+                async with semaphore:
+                    item[2].queue_wait += time.perf_counter() - waiting
+                    completion = await self.aget_completion(*item)
+                return self._parse_completion(completion)
+            except Exception as e:
+                self.logger.error("An error occurred: %s, this is the response from %s API: %s", e, self.api_name, completion)
+                return e
+
+        return await asyncio.gather(*[run(item) for item in self._prepare_batch(prompts)])
+
+    def _get_text_encoding(self) -> tiktoken.Encoding:
+        params = self._get_token_params(self.model)
+        return params[0] if params else self._get_encoding(self.model)
+
+    def _prompt_budget(self, prompt: str) -> int:
+        # what is left for the text once the history, the prompt around it and the completion are accounted for
+        token_limit = self.token_limits.get(self.model, 4096)
+        overhead = self.get_history_token_count() or 3
+        overhead += self._count_user_messages([prompt.replace("{text}", "").replace("{existing_answer}", "")])[0]
+        return token_limit - self.max_tokens - overhead
+
+    def compile_template(self, template: str) -> PromptTemplate:
+        return PromptTemplate(template, self._get_text_encoding())
+
+    def render(self, template: Union[str, PromptTemplate], overflow: str = "error", truncate: Optional[str] = None, **values) -> RenderedPrompt:
+        # the budget is whatever the history and max_tokens leave, for models with a known token limit
+        if isinstance(template, str):
+            template = self.compile_template(template)
+        max_tokens = None
+        if self.model in self.token_limits:
+            max_tokens = self.token_limits[self.model] - self.max_tokens - (self.get_history_token_count() or 3) - self._count_user_messages([""])[0]
+        return template.render(max_tokens, overflow, truncate, **values)
+
+    def chunk_text(self, text: Union[str, Iterable[str]], chunk_tokens: Optional[int] = None, overlap: int = 0, separator: str = "\n") -> Iterator[str]:
+        if chunk_tokens is None:
+            chunk_tokens = self._prompt_budget("")
+        if chunk_tokens <= overlap:
+            raise TokenLimitError(f"Chunks of {chunk_tokens} tokens can't overlap by {overlap} tokens")
+        encoding = self._get_text_encoding()
+        pieces = [text] if isinstance(text, str) else text
+        buffer: List[int] = []
+        previous = None
+        # pieces are consumed one at a time, so a generator of pages or a file object is never loaded as a whole
+        for piece in pieces:
+            # lines of a file already end with the separator, so it is only added where it is missing
+            if previous is not None and separator and not previous.endswith(separator):
+                previous, piece = piece, separator + piece
+            else:
+                previous = piece
+            buffer.extend(encoding.encode(piece))
+            while len(buffer) > chunk_tokens:
+                cut = chunk_tokens
+                # don't split a multi-byte character between two chunks
+                while cut > 1 and encoding.decode_single_token_bytes(buffer[cut])[0] & 0xC0 == 0x80:
+                    cut -= 1
+                yield encoding.decode(buffer[:cut])
+                buffer = buffer[max(cut - overlap, 1):]
+        if buffer:
+            yield encoding.decode(buffer)
+
+    def _generate_detached(self, prompts: List[str], max_concurrency: Optional[int] = None) -> List[str]:
+        results = self.generate_many(prompts, max_concurrency)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def map_reduce(self, text: Union[str, Iterable[str]], map_prompt: str, reduce_prompt: str, chunk_tokens: Optional[int] = None, max_concurrency: Optional[int] = None) -> str:
+        # prompts use {text} as the placeholder, plain replace is used since documents are full of braces
+        batch_size = max_concurrency or self.config.pool_size
+        partials: List[str] = []
+        batch: List[str] = []
+        for chunk in self.chunk_text(text, chunk_tokens or self._prompt_budget(map_prompt)):
+            batch.append(map_prompt.replace("{text}", chunk))
+            if len(batch) == batch_size:
+                partials.extend(self._generate_detached(batch, max_concurrency))
+                batch = []
+        if batch:
+            partials.extend(self._generate_detached(batch, max_concurrency))
+        self.logger.info("Mapped the text into %d partial answers", len(partials))
+        return self._reduce(partials, reduce_prompt, max_concurrency)
+
+    def _reduce(self, partials: List[str], reduce_prompt: str, max_concurrency: Optional[int] = None) -> str:
+        budget = self._prompt_budget(reduce_prompt)
+        encoding = self._get_text_encoding()
+        separator = "\n\n"
+        separator_tokens = len(encoding.encode(separator))
+        previous_tokens = None
+        while True:
+            groups: List[List[str]] = [[]]
+            group_tokens = total_tokens = 0
+            for partial in partials:
+                tokens = len(encoding.encode(partial)) + separator_tokens
+                total_tokens += tokens
+                if groups[-1] and group_tokens + tokens > budget:
+                    groups.append([])
+                    group_tokens = 0
+                groups[-1].append(partial)
+                group_tokens += tokens
+            prompts = [reduce_prompt.replace("{text}", separator.join(group)) for group in groups]
+            if len(groups) == 1:
+                return self._generate_detached(prompts)[0]
+            # a round only helps if it made the partials shorter, even when none of them could be paired up
+            if previous_tokens is not None and total_tokens >= previous_tokens:
+                raise TokenLimitError(f"Reducing the partial answers doesn't make them shorter, they still take {total_tokens} tokens and the budget is {budget} tokens")
+            previous_tokens = total_tokens
+            # the combined partials overflow the context, so every group (or every partial, if no two fit together) is reduced
+            # on its own and the results are combined again
+            self.logger.info("Reducing %d partial answers in %d groups", len(partials), len(groups))
+            partials = self._generate_detached(prompts, max_concurrency)
+
+    def _ask(self, prompt: str) -> str:
+        prepared = self._prepare_batch([prompt])[0]
+        if isinstance(prepared, Exception):
+            raise prepared
+        return self._parse_completion(self.get_completion(*prepared))
+
+    async def _aask(self, prompt: str) -> str:
+        prepared = self._prepare_batch([prompt])[0]
+        if isinstance(prepared, Exception):
+            raise prepared
+        return self._parse_completion(await self.aget_completion(*prepared))
+
+    def _bind(self, prompt: Union[str, PromptTemplate], values: Dict[str, str]) -> Union[str, PromptTemplate]:
+        # the placeholders other than {text} are the same for every chunk, so a plain prompt has them filled in once
+        if isinstance(prompt, PromptTemplate):
+            return prompt
+        for name, value in values.items():
+            prompt = prompt.replace(f"{{{name}}}", str(value))
+        return prompt
+
+    def _fill(self, prompt: Union[str, PromptTemplate], chunk: str, values: Dict[str, str]) -> str:
+        # a compiled template comes with its token count, a plain prompt uses {text} like map_reduce
+        if isinstance(prompt, PromptTemplate):
+            return self.render(prompt, overflow="truncate", text=chunk, **values)
+        return prompt.replace("{text}", chunk)
+
+    def _add_answer(self, best: _BestAnswers, index: int, future: Union[futures.Future, asyncio.Future]):
+        # one failed chunk shouldn't throw away the answers scored so far, it is logged and skipped like an unscored answer
+        error = future.exception()
+        if error is not None:
+            self.logger.error("An error occurred: %s, skipped chunk %d", error, index)
+            return
+        best.add(index, future.result())
+
+    def best_of(self, text: Union[str, Iterable[str]], prompt: Union[str, PromptTemplate], score: Callable[[str], Optional[float]] = extract_score, top_k: int = 1, threshold: Optional[float] = None, chunk_tokens: Optional[int] = None, max_concurrency: Optional[int] = None, **values) -> List[Tuple[float, str]]:
+        # asks prompt of every chunk concurrently and returns the top_k (score, answer) pairs, best first. Chunks are sent
+        # as slots free up, so once top_k answers score at least threshold the rest are never sent. Answers that score None
+        # are skipped, and so are chunks whose request failed. Threads can't abort a request, the ones already in flight
+        # finish in the background. values fill the other placeholders of the prompt
+        prompt = self._bind(prompt, values)
+        workers = max_concurrency or self.config.pool_size
+        chunks = enumerate(self.chunk_text(text, chunk_tokens or self._prompt_budget(getattr(prompt, "template", prompt))))
+        best = _BestAnswers(score, top_k, threshold)
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        pending: Dict[futures.Future, int] = {}
+        try:
+            while True:
+                for index, chunk in chunks:
+                    pending[executor.submit(self._ask, self._fill(prompt, chunk, values))] = index
+                    if len(pending) == workers:
+                        break
+                if not pending:
+                    break
+                finished, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    self._add_answer(best, pending.pop(future), future)
+                if best.done:
+                    self.logger.info("Reached the score threshold, %d requests still in flight were dropped", len(pending))
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return best.result()
+
+    async def abest_of(self, text: Union[str, Iterable[str]], prompt: Union[str, PromptTemplate], score: Callable[[str], Optional[float]] = extract_score, top_k: int = 1, threshold: Optional[float] = None, chunk_tokens: Optional[int] = None, max_concurrency: Optional[int] = None, **values) -> List[Tuple[float, str]]:
+        # same as best_of, but the requests still in flight are cancelled once the threshold is reached
+        prompt = self._bind(prompt, values)
+        workers = max_concurrency or self.config.max_concurrency
+        chunks = enumerate(self.chunk_text(text, chunk_tokens or self._prompt_budget(getattr(prompt, "template", prompt))))
+        best = _BestAnswers(score, top_k, threshold)
+        pending: Dict[asyncio.Task, int] = {}
+        try:
+            while True:
+                for index, chunk in chunks:
+                    pending[asyncio.ensure_future(self._aask(self._fill(prompt, chunk, values)))] = index
+                    if len(pending) == workers:
+                        break
+                if not pending:
+                    break
+                finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    self._add_answer(best, pending.pop(task), task)
+                if best.done:
+                    self.logger.info("Reached the score threshold, cancelled %d requests in flight", len(pending))
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return best.result()
+
+    def refine(self, text: Union[str, Iterable[str]], initial_prompt: str, refine_prompt: str, chunk_tokens: Optional[int] = None) -> str:
+        # the room for the text in the refine prompt is what the existing answer actually leaves, so the text after the
+        # first chunk is split again as the answer changes
+        encoding = self._get_text_encoding()
+        refine_budget = self._prompt_budget(refine_prompt)
+        answer = None
+        rest = ""
+
+        def refine_step(flush: bool) -> bool:
+            nonlocal answer, rest
+            budget = refine_budget - len(encoding.encode(answer))
+            if chunk_tokens:
+                budget = min(budget, chunk_tokens)
+            if budget <= 0:
+                raise TokenLimitError(f"The existing answer leaves no room for the text in the refine prompt, the budget is {refine_budget} tokens. Probably you should decrease max_tokens")
+            if len(encoding.encode(rest)) > budget:
+                piece = next(self.chunk_text(rest, budget))
+            elif flush:
+                piece = rest
+            else:
+                return False
+            rest = rest[len(piece):]
+            answer = self._generate_detached([refine_prompt.replace("{existing_answer}", answer).replace("{text}", piece)])[0]
+            return bool(rest)
+
+        for chunk in self.chunk_text(text, chunk_tokens or self._prompt_budget(initial_prompt)):
+            if answer is None:
+                answer = self._generate_detached([initial_prompt.replace("{text}", chunk)])[0]
+                continue
+            rest += chunk
+            while refine_step(False):
+                pass
+        while rest and refine_step(True):
+            pass
+        return answer or ""
+
+class AzureLloom(Lloom):
+    api_name: str = "Azure OpenAI"
+
+    def __init__(self, config: AzureLloomConfig, **kwargs):
         self.api_type = "azure"
-        self.api_key = config.api_key
-        self.api_base = config.api_base
         self.api_version = config.api_version
-        self.model = config.model
         self.engine = config.engine
-        self.temperature = config.temperature
-        self.max_tokens = config.max_tokens
-        self.top_p = config.top_p
-        self.frequency_penalty = config.frequency_penalty
-        self.presence_penalty = config.presence_penalty
-        self.system_message: Dict[str, str] = {"role": "system", "content": config.system_message} if config.system_message else None
-        self.messages: List[Dict[str, str]] = [self.system_message] if config.system_message else []
-        if config.logging:
-            self.logger.setLevel(logging.INFO)
-        else:
-            self.logger.setLevel(logging.WARNING)
+        super().__init__(config, **kwargs)
 
-    def get_completion(self, messages: List[Dict[str, str]]):
+    def _build_request(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> Tuple[str, Dict[str, str], Dict]:
         url = f"{self.api_base}openai/deployments/{self.engine}/chat/completions?api-version={self.api_version}"
         headers = {
             "Content-Type": "application/json",
@@ -259,15 +3010,338 @@ class AzureLloom(Lloom):
         }
         data = {
             "messages": messages,
-            "max_tokens": self.max_tokens,
+            "max_tokens": max_tokens or self.max_tokens,
             "temperature": self.temperature,
             "frequency_penalty": self.frequency_penalty,
             "presence_penalty": self.presence_penalty,
             "top_p": self.top_p,
             "stop": None
         }
+        return url, headers, data
+
+class Endpoint:
+    def __init__(self, client: Lloom, weight: float = 1.0):
+        self.client = client
+        self.weight = weight
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def name(self) -> str:
+        return getattr(self.client, "engine", None) or self.client.api_base
+
+class RoutedLloom(Lloom):
+    api_name: str = "Router"
+
+    def __init__(self, configs: List[LloomConfig], weights: Optional[List[float]] = None, strategy: str = "least_outstanding", ejection_time: float = 1.0, max_ejection_time: float = 30.0, **kwargs):
+        if not configs:
+            raise ValueError("At least one endpoint config is required")
+        if strategy not in ("least_outstanding", "weighted"):
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        if weights is not None and len(weights) != len(configs):
+            raise ValueError(f"Got {len(weights)} weights for {len(configs)} endpoint configs")
+        if weights is not None and not all(weight > 0 for weight in weights):
+            raise ValueError(f"Endpoint weights have to be positive, got {weights}")
+        self.strategy = strategy
+        self.ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+        self._endpoints_lock = threading.Lock()
+        self.endpoints: List[Endpoint] = []
+        for config, weight in zip(configs, weights or [1.0] * len(configs)):
+            client_class = AzureLloom if isinstance(config, AzureLloomConfig) else Lloom
+            # endpoints fail fast, retrying is done by moving the request to another endpoint
+            client = client_class(config, transport=kwargs.get("transport"), async_transport=kwargs.get("async_transport"), retry_policy=RetryPolicy(max_retries=0))
+            self.endpoints.append(Endpoint(client, weight))
+        # the conversation, token counting and sampling parameters come from the first config
+        super().__init__(configs[0], **kwargs)
+
+    async def aclose(self):
+        transports = {id(client.async_transport): client.async_transport for client in [self] + [e.client for e in self.endpoints]}
+        for transport in transports.values():
+            await transport.close()
+
+    def _pick_endpoint(self, exclude: set) -> Optional[Endpoint]:
+        now = time.time()
+        with self._endpoints_lock:
+            healthy = [e for e in self.endpoints if e.ejected_until <= now and e not in exclude]
+            if not healthy:
+                return None
+            if self.strategy == "weighted":
+                endpoint = random.choices(healthy, [e.weight for e in healthy])[0]
+            else:
+                endpoint = min(healthy, key=lambda e: (e.outstanding / e.weight, random.random()))
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _release_endpoint(self, endpoint: Endpoint, error: Optional[LloomAPIError] = None):
+        with self._endpoints_lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.failures = 0
+                return
+            now = time.time()
+            # requests that were already in flight when the endpoint got ejected don't extend the ejection
+            if not self._is_retryable(error) or endpoint.ejected_until > now:
+                return
+            endpoint.failures += 1
+            ejection = min(self.max_ejection_time, self.ejection_time * 2 ** (endpoint.failures - 1))
+            endpoint.ejected_until = now + ejection
+        self.logger.warning("Endpoint %s failed with %s, ejecting it for %.2f seconds", endpoint.name, error.status_code or "a connection error", ejection)
+
+    def _ejection_wait(self) -> float:
+        with self._endpoints_lock:
+            return max(0.0, min(e.ejected_until for e in self.endpoints) - time.time())
+
+    def _is_retryable(self, error: LloomAPIError) -> bool:
+        # client errors like 400 or 401 would fail the same way anywhere else
+        return error.status_code is None or error.status_code in self.retry_policy.retry_statuses
+
+    def _can_fail_over(self, error: LloomAPIError, attempt: int) -> bool:
+        return self._is_retryable(error) and attempt < self.retry_policy.max_retries
+
+    def _endpoint_request(self, endpoint: Endpoint, data: Dict) -> Tuple[str, Dict[str, str], Dict]:
+        # the url, the credentials and the model belong to the endpoint, everything else to this conversation
+        url, headers, endpoint_data = endpoint.client._build_request(data["messages"], data["max_tokens"])
+        routed = {k: v for k, v in data.items() if k != "model"}
+        if "model" in endpoint_data:
+            routed["model"] = endpoint_data["model"]
+        return url, headers, routed
+
+    def _send(self, url: str, headers: Dict[str, str], data: Dict, stream: bool = False, metrics: Optional[RequestMetrics] = None) -> requests.Response:
+        metrics = metrics or RequestMetrics(self.model, stream)
+        tried = set()
+        attempt = 0
+        while True:
+            endpoint = self._pick_endpoint(tried)
+            if endpoint is None:
+                # every endpoint is ejected or has already failed this request, wait for the first one to come back
+                tried.clear()
+                time.sleep(self._ejection_wait())
+                continue
+            try:
+                response = endpoint.client._send(*self._endpoint_request(endpoint, data), stream=stream, metrics=metrics)
+            except LloomAPIError as e:
+                self._release_endpoint(endpoint, e)
+                if not self._can_fail_over(e, attempt):
+                    raise
+                tried.add(endpoint)
+                attempt += 1
+                metrics.retries = attempt
+            except BaseException:
+                self._release_endpoint(endpoint)
+                raise
+            else:
+                self._release_endpoint(endpoint)
+                return response
+
+    async def _asend(self, url: str, headers: Dict[str, str], data: Dict, metrics: Optional[RequestMetrics] = None) -> AsyncResponse:
+        metrics = metrics or RequestMetrics(self.model)
+        tried = set()
+        attempt = 0
+        while True:
+            endpoint = self._pick_endpoint(tried)
+            if endpoint is None:
+                tried.clear()
+                await asyncio.sleep(self._ejection_wait())
+                continue
+            try:
+                response = await endpoint.client._asend(*self._endpoint_request(endpoint, data), metrics)
+            except LloomAPIError as e:
+                self._release_endpoint(endpoint, e)
+                if not self._can_fail_over(e, attempt):
+                    raise
+                tried.add(endpoint)
+                attempt += 1
+                metrics.retries = attempt
+            except BaseException:
+                self._release_endpoint(endpoint)
+                raise
+            else:
+                self._release_endpoint(endpoint)
+                return response
+
+    async def _astream(self, url: str, headers: Dict[str, str], data: Dict, metrics: RequestMetrics) -> AsyncIterator[str]:
+        tried = set()
+        attempt = 0
+        while True:
+            endpoint = self._pick_endpoint(tried)
+            if endpoint is None:
+                tried.clear()
+                await asyncio.sleep(self._ejection_wait())
+                continue
+            stream = endpoint.client._astream(*self._endpoint_request(endpoint, data), metrics)
+            # a stream can only move to another endpoint until its first delta has been passed on
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                self._release_endpoint(endpoint)
+                return
+            except LloomAPIError as e:
+                await stream.aclose()
+                self._release_endpoint(endpoint, e)
+                if not self._can_fail_over(e, attempt):
+                    raise
+                tried.add(endpoint)
+                attempt += 1
+                metrics.retries = attempt
+                continue
+            except BaseException:
+                await stream.aclose()
+                self._release_endpoint(endpoint)
+                raise
+            self._release_endpoint(endpoint)
+            try:
+                yield first
+                async for delta in stream:
+                    yield delta
+            finally:
+                await stream.aclose()
+            return
+
+class Session:
+    # a conversation of a SessionManager, its calls run one at a time in the order they were made
+    def __init__(self, manager: "SessionManager", session_id: str, client: Lloom):
+        self.manager = manager
+        self.session_id = session_id
+        self.client = client
+        self.last_used = time.time()
+        self.lock = FairSemaphore(1)
+        self._users = 0
+
+    @property
+    def messages(self) -> MessageList:
+        return self.client.messages
+
+    @contextlib.contextmanager
+    def _turn(self):
+        self.manager._check_out(self)
+        try:
+            # the session lock comes first, so only sessions that can actually send wait for a request slot
+            with self.lock, self.manager.scheduler:
+                yield
+        finally:
+            self.manager._check_in(self)
+
+    @contextlib.asynccontextmanager
+    async def _aturn(self):
+        self.manager._check_out(self)
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(data))
-        except Exception as e: 
-            self.logger.error(f"An error occurred while trying to get a response from Azure OpenAI: {e}")
-        return(response.json())
+            async with self.lock, self.manager.scheduler:
+                yield
+        finally:
+            self.manager._check_in(self)
+
+    def generate(self, prompt: str) -> str:
+        with self._turn():
+            return self.client.generate(prompt)
+
+    async def agenerate(self, prompt: str) -> str:
+        async with self._aturn():
+            return await self.client.agenerate(prompt)
+
+    def generate_stream(self, prompt: str, stop: Optional[Union[str, List[str]]] = None) -> Iterator[str]:
+        with self._turn():
+            yield from self.client.generate_stream(prompt, stop)
+
+    async def agenerate_stream(self, prompt: str, stop: Optional[Union[str, List[str]]] = None) -> AsyncIterator[str]:
+        async with self._aturn():
+            async for delta in self.client.agenerate_stream(prompt, stop):
+                yield delta
+
+class SessionManager:
+    # serves many conversations from one process. Every session is a fork of client, so they share its config, transports,
+    # rate limiter, tokenizer and system message and only keep their own turns. The calls of all sessions queue for
+    # max_in_flight request slots first come first served, and a session never has more than one call queued, so a busy
+    # session can't crowd out the others
+    def __init__(self, client: Lloom, max_in_flight: Optional[int] = None, idle_timeout: Optional[float] = 1800.0, max_sessions: Optional[int] = None, store: Optional[HistoryStore] = None, hot_size: int = 64):
+        self.client = client
+        self.scheduler = FairSemaphore(max_in_flight or client.config.max_concurrency)
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.store = store
+        self.hot_size = hot_size
+        self.evicted = 0
+        # least recently used first, so idle sessions are always at the front
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def _open(self, session_id: str) -> Lloom:
+        client = self.client.fork()
+        if self.store is not None:
+            # an evicted or restarted session picks up its turns from the store
+            client.history = PersistentHistory(self.store, session_id, self.hot_size)
+            if not len(client.history):
+                client.history.reset(self.client.history.to_list())
+        return client
+
+    def get(self, session_id: str) -> Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(self, session_id, self._open(session_id))
+            else:
+                self._sessions.move_to_end(session_id)
+                session.last_used = time.time()
+            self._evict()
+        return session
+
+    def close(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def evict_idle(self) -> int:
+        with self._lock:
+            evicted = self.evicted
+            self._evict()
+            return self.evicted - evicted
+
+    def _evict(self):
+        # runs on every get, it stops at the first session that is neither idle nor over max_sessions
+        now = time.time()
+        for _ in range(len(self._sessions)):
+            session_id, session = next(iter(self._sessions.items()))
+            idle = self.idle_timeout is not None and now - session.last_used > self.idle_timeout
+            if not idle and (self.max_sessions is None or len(self._sessions) <= self.max_sessions):
+                break
+            if session._users:
+                # in the middle of a call, e.g. a long stream
+                session.last_used = now
+                self._sessions.move_to_end(session_id)
+                continue
+            del self._sessions[session_id]
+            self.evicted += 1
+            self.client.logger.info("Evicted session %s", session_id)
+
+    def _check_out(self, session: Session):
+        with self._lock:
+            session._users += 1
+            session.last_used = time.time()
+            # a handle that was kept after its session was evicted is still the same conversation
+            self._sessions.setdefault(session.session_id, session)
+            self._sessions.move_to_end(session.session_id)
+
+    def _check_in(self, session: Session):
+        with self._lock:
+            session._users -= 1
+            session.last_used = time.time()
+            if self._sessions.get(session.session_id) is session:
+                self._sessions.move_to_end(session.session_id)
+
+    def generate(self, session_id: str, prompt: str) -> str:
+        return self.get(session_id).generate(prompt)
+
+    async def agenerate(self, session_id: str, prompt: str) -> str:
+        return await self.get(session_id).agenerate(prompt)
+
+    def generate_stream(self, session_id: str, prompt: str, stop: Optional[Union[str, List[str]]] = None) -> Iterator[str]:
+        return self.get(session_id).generate_stream(prompt, stop)
+
+    def agenerate_stream(self, session_id: str, prompt: str, stop: Optional[Union[str, List[str]]] = None) -> AsyncIterator[str]:
+        return self.get(session_id).agenerate_stream(prompt, stop)